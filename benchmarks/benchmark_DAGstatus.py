@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+
+"""Benchmark parsing a DAGman node status file with DAGstatus.
+
+Generates a status file with 100k nodes (by default) in various states,
+some with StatusDetails containing = and ;, and compares the parser in
+DAGstatus with the old line-by-line one, checking they agree.
+
+With --coldStart N, also runs `DAGstatus -s` on a small status file N times
+in a fresh interpreter, and reports the median wall time, i.e. the latency
+of running it by hand (interpreter startup, imports, config, parse & print).
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+DAGSTATUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DAGstatus", "DAGstatus")
+
+
+def load_dagstatus():
+    """Import the DAGstatus script as a module"""
+    try:
+        from importlib.machinery import SourceFileLoader
+        import types
+        loader = SourceFileLoader("DAGstatus", DAGSTATUS_PATH)
+        module = types.ModuleType(loader.name)
+        module.__file__ = DAGSTATUS_PATH
+        loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source("DAGstatus", DAGSTATUS_PATH)
+
+
+DAG_HEADER = """[
+  Type = "DagStatus";
+  DagFiles = {
+    "copyCompress.dag"
+  };
+  Timestamp = 1530000000; /* "Tue Jun 26 10:00:00 2018" */
+  DagStatus = 3; /* "STATUS_SUBMITTED ()" */
+  NodesTotal = %(total)d;
+  NodesDone = %(done)d;
+  NodesPre = 0;
+  NodesQueued = %(queued)d;
+  NodesPost = 0;
+  NodesReady = 0;
+  NodesUnready = %(unready)d;
+  NodesFailed = %(failed)d;
+  JobProcsHeld = 0;
+  JobProcsIdle = %(idle)d; /* includes held */
+]
+"""
+
+NODE_TEMPLATE = """[
+  Type = "NodeStatus";
+  Node = "copyCompress_%(i)d";
+  NodeStatus = %(code)d; /* "%(status)s" */
+  StatusDetails = "%(details)s";
+  RetryCount = %(retries)d;
+  JobProcsQueued = %(queued)d;
+  JobProcsHeld = 0;
+]
+"""
+
+STATUS_END = """[
+  Type = "StatusEnd";
+  EndTime = 1530000000; /* "Tue Jun 26 10:00:00 2018" */
+  NextUpdate = 1530000120; /* "Tue Jun 26 10:02:00 2018" */
+]
+"""
+
+
+def make_status_file(filename, num_nodes):
+    """Write status file with num_nodes nodes in a mix of states"""
+    states = [
+        (5, "STATUS_DONE", ""),
+        (3, "STATUS_SUBMITTED", "idle"),
+        (3, "STATUS_SUBMITTED", "not_idle"),
+        (0, "STATUS_NOT_READY", ""),
+        (6, "STATUS_ERROR", 'Job proc (1.0.0) failed with status 1; exit=1 signal=0'),
+    ]
+    counts = {"done": 0, "queued": 0, "unready": 0, "failed": 0, "idle": 0}
+    with open(filename, "w") as f:
+        nodes = []
+        for i in range(num_nodes):
+            code, status, details = states[i % 7 % len(states)]
+            counts["done"] += code == 5
+            counts["queued"] += code == 3
+            counts["idle"] += details == "idle"
+            counts["unready"] += code == 0
+            counts["failed"] += code == 6
+            nodes.append(NODE_TEMPLATE % dict(i=i, code=code, status=status, details=details,
+                                              retries=i % 3, queued=int(code == 3)))
+        counts["total"] = num_nodes
+        f.write(DAG_HEADER % counts)
+        f.writelines(nodes)
+        f.write(STATUS_END)
+
+
+def time_cold_start(status_filename, num_runs):
+    """Run DAGstatus -s on status_filename num_runs times in new processes.
+
+    Returns
+    -------
+    list[float]
+        Wall time of each run in seconds
+    """
+    cmd = [sys.executable, DAGSTATUS_PATH, "-s", "--color", "never", status_filename]
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(num_runs):
+            start = time.time()
+            subprocess.check_call(cmd, stdout=devnull)
+            times.append(time.time() - start)
+    return times
+
+
+def old_interpret_status_file(status_filename):
+    """The old parser, returns list of (node, status, details, retries) for each node.
+
+    Note that it loses anything after a second = in a line.
+    """
+    def interpret_line(line):
+        raw = line.replace('\n', '').strip()
+        parts = [x.strip() for x in raw.split('=')]
+        other = [x.strip() for x in parts[1].split(";")]
+        value = other[0].replace('"', '')
+        if len(other) == 2:
+            comment = other[1].replace("/*", "").replace("*/", "").strip().replace('"', '')
+        else:
+            comment = ''
+        return parts[0], value, comment
+
+    nodes = []
+    with open(status_filename) as sfile:
+        contents = {}
+        store_contents = False
+        for line in sfile:
+            if line.startswith("[") or "}" in line:
+                store_contents = True
+                continue
+            elif line.startswith("]"):
+                if contents['Type'][0] == 'NodeStatus':
+                    nodes.append((contents['Node'][0], contents['NodeStatus'][1],
+                                  contents['StatusDetails'][0], int(contents['RetryCount'][0])))
+                contents = {}
+                store_contents = False
+                continue
+            elif "{" in line:
+                store_contents = False
+                continue
+            elif store_contents:
+                key, value, comment = interpret_line(line)
+                contents[key] = (value, comment)
+    return nodes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--numNodes", default=100000, type=int, help="Number of nodes in DAG")
+    parser.add_argument("--skipOld", action="store_true", help="Don't run the old parser")
+    parser.add_argument("--coldStart", default=0, type=int,
+                        help="Number of times to time a fresh `DAGstatus -s` on a 1k node file")
+    args = parser.parse_args()
+
+    DAGstatus = load_dagstatus()
+
+    tmp_dir = tempfile.mkdtemp(prefix="DAGstatus_bench_")
+    try:
+        status_filename = os.path.join(tmp_dir, "copyCompress.dag.status")
+        make_status_file(status_filename, args.numNodes)
+        print("Status file with", args.numNodes, "nodes:", os.path.getsize(status_filename) // 1024, "kB")
+
+        start = time.time()
+        dag_status, node_statuses, status_end = DAGstatus.interpret_status_file(status_filename)
+        new_time = time.time() - start
+        print("New parser: %.2f s (%.0f nodes/s)" % (new_time, len(node_statuses) / new_time))
+        if len(node_statuses) != args.numNodes or dag_status.nodes_total != args.numNodes:
+            raise RuntimeError("Found %d nodes, expected %d" % (len(node_statuses), args.numNodes))
+
+        if not args.skipOld:
+            start = time.time()
+            old_nodes = old_interpret_status_file(status_filename)
+            old_time = time.time() - start
+            print("Old parser: %.2f s (%.0f nodes/s)" % (old_time, len(old_nodes) / old_time))
+            print("Speedup x%.1f" % (old_time / new_time))
+            new_nodes = [(n.node, n.node_status, n.status_details, n.retry_count) for n in node_statuses]
+            # The old parser cuts StatusDetails at the first = or ;
+            differ = [(o, n) for o, n in zip(old_nodes, new_nodes) if o != n]
+            if any(o[:2] != n[:2] or o[3] != n[3] or "=" not in n[2] for o, n in differ):
+                raise RuntimeError("Old & new parsers disagree on more than StatusDetails with =")
+            print("Parsers agree, apart from %d StatusDetails containing =, e.g." % len(differ))
+            if differ:
+                print("  old:", repr(differ[0][0][2]))
+                print("  new:", repr(differ[0][1][2]))
+
+        if args.coldStart > 0:
+            small_filename = os.path.join(tmp_dir, "small.dag.status")
+            make_status_file(small_filename, 1000)
+            times = sorted(time_cold_start(small_filename, args.coldStart))
+            print("Cold start (%d runs): median %.0f ms, min %.0f ms, max %.0f ms"
+                  % (len(times), 1000 * times[len(times) // 2], 1000 * times[0], 1000 * times[-1]))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+
+"""Benchmark building the directory -> XMLs map in findAllNtupleDirs.
+
+Compares the old approach (for each directory, check every XML's list of
+directories) with the inverted index in make_dir_map(), on a synthetic
+release of ~20k XMLs, and checks both give identical _dir_map.txt output.
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from findAllNtupleDirs import make_dir_map
+from ntupleCatalogue import remove_crab_dir
+
+
+def make_release(num_xml, files_per_xml, seed=1):
+    """Make synthetic list of XML filenames, and list of ntuples in each.
+
+    Most XMLs use 1 directory (with CRAB 000X subdirs), some share a
+    directory with another XML, like extension samples.
+    """
+    rng = random.Random(seed)
+    xml_files = []
+    root_files_lists = []
+    for i in range(num_xml):
+        xml_files.append("RunII_102X_v2/201%d/MC_Sample%d.xml" % (6 + i % 3, i))
+        sample = i if rng.random() > 0.1 else rng.randrange(num_xml)
+        this_dir = "/pnfs/desy.de/cms/tier2/store/user/user%d/RunII_102X_v2/Sample%d/crab_Sample%d" % (i % 50, sample, sample)
+        root_files_lists.append(["%s/%04d/Ntuple_%d.root" % (this_dir, j // 1000, j)
+                                 for j in range(files_per_xml)])
+    return xml_files, root_files_lists
+
+
+def all_dirs(root_files_lists):
+    return sorted(list(set([remove_crab_dir(os.path.dirname(f))
+                            for rfl in root_files_lists for f in rfl])))
+
+
+def old_dir_map_lines(xml_files, root_files_lists, dirs):
+    """The original O(dirs x XMLs) way"""
+    lines = []
+    these_root_dirs_lists = [sorted(list(set([remove_crab_dir(os.path.dirname(r))
+                                              for r in rfl])))
+                             for rfl in root_files_lists]
+    for rd in dirs:
+        lines.append(rd + "::\n")
+        for ind, rdl in enumerate(these_root_dirs_lists):
+            if rd in rdl:
+                lines.append("\t" + xml_files[ind] + "\n")
+    return lines
+
+
+def new_dir_map_lines(xml_files, root_files_lists, dirs):
+    """Using the inverted index"""
+    lines = []
+    dir_map = make_dir_map(root_files_lists)
+    for rd in dirs:
+        lines.append(rd + "::\n")
+        for ind in dir_map[rd]:
+            lines.append("\t" + xml_files[ind] + "\n")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--numXML", default=20000, type=int, help="Number of XML files")
+    parser.add_argument("--filesPerXML", default=50, type=int, help="Number of ntuples per XML")
+    parser.add_argument("--skipOld", action="store_true", help="Don't run the (slow) old method")
+    args = parser.parse_args()
+
+    xml_files, root_files_lists = make_release(args.numXML, args.filesPerXML)
+    # This is needed in findAllNtupleDirs anyway, so don't time it
+    dirs = all_dirs(root_files_lists)
+    print("Synthetic release:", len(xml_files), "XMLs,", len(dirs), "directories")
+
+    start = time.time()
+    new_lines = new_dir_map_lines(xml_files, root_files_lists, dirs)
+    new_time = time.time() - start
+    print("New (inverted index): %.2f s" % new_time)
+
+    if not args.skipOld:
+        start = time.time()
+        old_lines = old_dir_map_lines(xml_files, root_files_lists, dirs)
+        old_time = time.time() - start
+        print("Old (dirs x XMLs):    %.2f s" % old_time)
+        if old_lines != new_lines:
+            raise RuntimeError("Old and new dir maps differ!")
+        print("Outputs identical, speedup x%.0f" % (old_time / new_time))
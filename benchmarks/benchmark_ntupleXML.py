@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+
+"""Benchmark ntupleXML parsing throughput on a synthetic corpus of XML files.
+
+The default corpus mimics a full UHH2-datasets checkout: 10k XML files with
+5M ntuple entries in total, some of them in single- and multi-line comments.
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ntupleXML import iter_corpus_entries
+
+
+ENTRY_TEMPLATE = '<In FileName="/pnfs/desy.de/cms/tier2/store/user/%s/RunII_102X_v2/%s/crab_%s/0000/Ntuple_%d.root" Lumi="0.0"/>\n'
+
+
+def make_corpus(top_dir, num_xml, num_entries):
+    """Write num_xml XML files under top_dir with num_entries entries in total.
+
+    Returns list of XML filenames and the number of un-commented entries.
+    """
+    per_xml = num_entries // num_xml
+    xml_filenames = []
+    num_uncommented = 0
+    for i in range(num_xml):
+        sample = "Sample%d" % i
+        this_dir = os.path.join(top_dir, "RunII_102X_v2", "201%d" % (6 + i % 3))
+        if not os.path.isdir(this_dir):
+            os.makedirs(this_dir)
+        xml_filename = os.path.join(this_dir, "MC_%s.xml" % sample)
+        with open(xml_filename, "w") as f:
+            for j in range(per_xml):
+                entry = ENTRY_TEMPLATE % ("user%d" % (i % 20), sample, sample, j)
+                if j % 100 == 1:
+                    # single-line comment
+                    f.write("<!-- " + entry.rstrip() + " -->\n")
+                elif j % 100 == 10:
+                    # start of multi-line comment block, ends 5 entries later
+                    f.write("<!--\n" + entry)
+                elif j % 100 == 15:
+                    f.write(entry + "-->\n")
+                else:
+                    f.write(entry)
+                    if not (10 < j % 100 < 15):
+                        num_uncommented += 1
+        xml_filenames.append(xml_filename)
+    return xml_filenames, num_uncommented
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--numXML", default=10000, type=int, help="Number of XML files")
+    parser.add_argument("--numEntries", default=5000000, type=int, help="Total number of entries")
+    parser.add_argument("--keep", help="Keep corpus in this directory instead of a temporary one")
+    args = parser.parse_args()
+
+    top_dir = args.keep or tempfile.mkdtemp(prefix="ntupleXML_bench_")
+    try:
+        print("Writing corpus of", args.numXML, "XMLs,", args.numEntries, "entries to", top_dir)
+        start = time.time()
+        xml_filenames, num_expected = make_corpus(top_dir, args.numXML, args.numEntries)
+        print("Corpus written in %.1f s" % (time.time() - start))
+
+        start = time.time()
+        num_found = 0
+        for xml_filename, entry in iter_corpus_entries(xml_filenames):
+            num_found += 1
+        duration = time.time() - start
+
+        if num_found != num_expected:
+            raise RuntimeError("Found %d entries, expected %d" % (num_found, num_expected))
+
+        print("Parsed %d XMLs / %d entries in %.2f s" % (len(xml_filenames), num_found, duration))
+        print("Throughput: %.0f XMLs/s, %.0f entries/s" % (len(xml_filenames) / duration, num_found / duration))
+    finally:
+        if not args.keep:
+            shutil.rmtree(top_dir)
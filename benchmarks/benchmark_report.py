@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+
+"""Benchmark the datasetInfo storage report on a synthetic table.
+
+The default table has 10M rows, with some ntuples used by more than 1 XML
+(like extension samples), and checks the hashed-path deduplication against
+counting distinct path strings.
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from datasetInfo import NtupleTable, make_report
+
+
+def make_table(num_rows, num_xml, shared_fraction=0.05, seed=1):
+    """Make synthetic dataset info table, where shared_fraction of rows repeat an earlier ntuple"""
+    rng = np.random.RandomState(seed)
+    per_xml = max(1, num_rows // num_xml)
+    table = NtupleTable()
+    sizes = rng.uniform(100, 3000, size=num_rows)
+    shared = rng.uniform(size=num_rows) < shared_fraction
+    for i in range(num_rows):
+        xml = i // per_xml
+        year = "201%d" % (6 + xml % 3)
+        xmldir = "RunII_102X_v2/%s" % year
+        user = "user%d" % (xml % 50)
+        # Reuse an ntuple from the start of the table for shared rows
+        j = i % 1000 if shared[i] and i >= 1000 else i
+        ntuple = "/pnfs/desy.de/cms/tier2/store/user/%s/Sample%d/Ntuple_%d.root" % (user, j // per_xml, j)
+        table.append(xmldir=xmldir, xml="%s/MC_Sample%d.xml" % (xmldir, xml),
+                     ntuple=ntuple, size=sizes[j], user=user, year=year)
+    return table.to_dataframe()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--numRows", default=10000000, type=int, help="Number of rows in table")
+    parser.add_argument("--numXML", default=20000, type=int, help="Number of XML files")
+    args = parser.parse_args()
+
+    start = time.time()
+    df = make_table(args.numRows, args.numXML)
+    print("Made table of %d rows in %.1f s" % (len(df), time.time() - start))
+
+    start = time.time()
+    report = make_report(df)
+    duration = time.time() - start
+    print("Report (all groupings) in %.2f s" % duration)
+
+    start = time.time()
+    num_unique = df["ntuple"].nunique()
+    print("String nunique() alone in %.2f s" % (time.time() - start))
+    if num_unique != report["total"]["unique_ntuples"]:
+        raise RuntimeError("Report found %d unique ntuples, expected %d"
+                           % (report["total"]["unique_ntuples"], num_unique))
+    print("Unique ntuples match:", num_unique)
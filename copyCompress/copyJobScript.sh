@@ -4,18 +4,37 @@ set -u
 
 # Copy a file using gfal tools & check it's copied successfully
 # Usage:
-# ./copyJobSsript.sh <src file> <destination> <1 for force copy, 0 for error if destination already exists (default)>
+# ./copyJobSsript.sh <src file> <destination> <1 for force copy, 0 for error if destination already exists (default)> <ledger file (optional)> <deep check % (optional)>
 #
 # Both should *NOT* use the srm:// ... prefix
+#
+# The copy is checked by gfal comparing the adler32 checksums of source & destination
+# (dCache stores these, otherwise gfal computes them reading each file once),
+# and the number of events in each from the tree header (countEvents fast mode).
+# The given % of files (default 0) are also checked by reading every entry of the
+# destination tree, which is much slower.
+#
+# If a ledger file is given, a line is added to it once the copy is verified:
+# <src file> <destination> <destination size in bytes> <number of events>, separated by tabs
 
 SRC="$1"
 DEST="$2"
 FORCE=0
+LEDGER=""
+DEEPCHECK=0
 
-if (( $# == 3 )); then
+if (( $# >= 3 )); then
     FORCE="$3"
 fi
 
+if (( $# >= 4 )); then
+    LEDGER="$4"
+fi
+
+if (( $# >= 5 )); then
+    DEEPCHECK="$5"
+fi
+
 # Do some checks
 SRCBASENAME=$(basename "$SRC")
 
@@ -49,14 +68,34 @@ FORCEOPT=""
 if (( $FORCE == 1 )); then
     FORCEOPT="-f"
 fi
-gfal-copy -pr --nbstreams=2 --timeout=28800 "$FORCEOPT" "$SRC" "$DEST"
+# -K makes gfal-copy fail if the checksums differ
+gfal-copy -pr --nbstreams=2 --timeout=28800 -K ADLER32 "$FORCEOPT" "$SRC" "$DEST"
 
-# Now check we copied across successfully by counting number of events
-# (using proper tree traversal, not Fast method)
-numsrc=$(./countEvents "${SRCLOCAL}" 0)
-numdest=$(./countEvents "${DESTLOCAL}" 0)
+# Now check the destination is a readable ntuple with the same number of events.
+# The checksum already shows the bytes are the same, so the tree header is enough.
+numsrc=$(./countEvents "${SRCLOCAL}" 1)
+numdest=$(./countEvents "${DESTLOCAL}" 1)
 if (( $numsrc != $numdest )); then
     echo "Mismatch in # events: $numsrc vs $numdest"
     exit 12
 fi
-echo "Same # events: $numsrc"
\ No newline at end of file
+echo "Same # events: $numsrc"
+
+if (( RANDOM % 100 < DEEPCHECK )); then
+    # Read every entry of the copy, to check it all decompresses
+    numdeep=$(./countEvents "${DESTLOCAL}" 0)
+    if (( $numdeep != $numdest )); then
+        echo "Mismatch in # events reading all entries: $numdeep vs $numdest in header"
+        exit 12
+    fi
+    echo "Deep check OK: $numdeep"
+fi
+
+if [[ -n "$LEDGER" ]]; then
+    size=$(stat -c %s "${DESTLOCAL}")
+    # Lock, since many jobs write to the same ledger
+    (
+        flock 9
+        printf '%s\t%s\t%s\t%s\n' "$SRCLOCAL" "$DESTLOCAL" "$size" "$numsrc" >&9
+    ) 9>>"$LEDGER"
+fi
\ No newline at end of file
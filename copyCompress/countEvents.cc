@@ -7,7 +7,13 @@
 using namespace std;
 
 
-int countTreeEventsFast(TFile * f) {
+long long countTreeEventsFast(TFile * f) {
+  // Only reads the tree header, not the entries.
+  // A file that ROOT had to recover (e.g. truncated) may have a header that doesn't
+  // match its contents, so don't trust it
+  if (f->TestBit(TFile::kRecovered)) {
+    throw runtime_error("File was not closed properly, had to be recovered");
+  }
   TTree * tree = (TTree*) f->Get("AnalysisTree");
   if (tree == nullptr) {
     throw runtime_error("Couldn't get tree from TFile");
@@ -15,11 +21,11 @@ int countTreeEventsFast(TFile * f) {
   return tree->GetEntriesFast();
 }
 
-int countTreeEventsSlow(TFile * f) {
+long long countTreeEventsSlow(TFile * f) {
   // Could we just use TTree->GetEntries() here instead? Or GetEntries("")?
   // (since the former just returns a class variable)
   TTreeReader myReader("AnalysisTree", f);
-  int nEvents = 0;
+  long long nEvents = 0;
   while (myReader.Next()) {
     nEvents++;
   }
@@ -29,14 +35,14 @@ int countTreeEventsSlow(TFile * f) {
 /**
  * Count number of events in TTree.
  * mode == "1" for fast, "0" for actually iterating through tree
- * Latter ensures you read each entry in the tree.
+ * Latter ensures you read each entry in the tree, but reads the whole file.
  */
-int countEvents(std::string src, std::string mode) {
+long long countEvents(std::string src, std::string mode) {
   TFile * fin = TFile::Open(src.c_str());
-  if (fin->IsZombie() || fin == nullptr) {
+  if (fin == nullptr || fin->IsZombie()) {
     throw runtime_error("Couldn't open source " + src);
   }
-  int result = 0;
+  long long result = 0;
   if (mode == "1") {
     result = countTreeEventsFast(fin);
   } else {
@@ -50,7 +56,7 @@ int main(int argc, char** argv) {
   if (argc != 3) {
     throw runtime_error("Usage: ./countEvents <source> <1 for fast, 0 for tree iteration>");
   }
-  int num = countEvents(argv[1], argv[2]);
+  long long num = countEvents(argv[1], argv[2]);
   cout << num << endl;
   return 0;
 }
\ No newline at end of file
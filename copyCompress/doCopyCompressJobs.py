@@ -8,8 +8,11 @@ from __future__ import print_function
 
 import os
 import sys
+import math
+import heapq
 import argparse
 import subprocess
+from collections import Counter, OrderedDict
 from shutil import copy2, rmtree
 try:
     # py3
@@ -18,6 +21,11 @@ except ImportError:
     # py2
     from itertools import izip_longest as zip_longest
 
+# ntupleXML lives in the top directory of UHH2-utils
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ntupleXML import iter_xml_entries
+from ntupleStat import StatEngine
+
 
 SRM_PREFIX = "srm://dcache-se-cms.desy.de:8443"
 
@@ -106,7 +114,14 @@ use_x509userproxy = True
 # Need to copy: cp $(voms-proxy-info -p) ~/x509_proxy
 # Or somehow set X509_USER_PROXY env var
 x509userproxy     = $ENV(HOME)/x509_proxy
-arguments         = $(scriptargs)
+# Always run in a scratch dir with its own copy of the scripts & mapping file,
+# so nothing left in initialdir can be picked up instead
+should_transfer_files = YES
+transfer_input_files = copyJobScript.sh, countEvents, {mapping}
+# Each job copies lines [start, end) of the (transferred) mapping file,
+# records verified copies in the ledger, fully reads deep_check % of them,
+# and runs up to transfers copies at once
+arguments         = {mapping_name} $(start) $(end) {ledger} {deep_check} {transfers}
 queue
 """
 
@@ -124,38 +139,17 @@ def setup_dir(dir_name, rm_existing=True):
         os.makedirs(dir_name)
 
 
-def extract_root_filename(line):
-    """Get ROOT filename from line in XML file
-
-    Parameters
-    ----------
-    line : str
-
-    Returns
-    -------
-    str
-        Ntuple filepath, sanitised to remove e.g //, which can affect splitting
-    """
-    this_line = line.replace('<In FileName="', '').replace('" Lumi="0.0"/>', '')
-    this_line = os.path.realpath(this_line)
-    return this_line
-
-
 def get_root_files_from_xml(xml_filename):
     """Get list of all ROOT ntuples from XML file
 
-    Filenames are sanitised for //, comments are ignored, and
-    only files stored on /nfs or /pnfs are considered
+    Filenames are sanitised for //, which can affect splitting,
+    comments are ignored, and only files stored on /nfs or /pnfs are considered
     """
     root_filenames = []
-    with open(xml_filename) as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith(("<!--", "-->")):
-                continue
-            root_filename = extract_root_filename(line)
-            if root_filename.startswith(("/nfs", "/pnfs")):
-                root_filenames.append(os.path.realpath(root_filename))
+    for entry in iter_xml_entries(xml_filename):
+        root_filename = os.path.realpath(entry.path)
+        if root_filename.startswith(("/nfs", "/pnfs")):
+            root_filenames.append(root_filename)
     return root_filenames
 
 
@@ -277,6 +271,74 @@ def save_mapping_to_file(filename_mapping, output_filename):
             outf.write('%s:%s\n' % (k, v))
 
 
+# Name of file in the job directory where jobs record each verified copy
+LEDGER_FILENAME = "ledger.txt"
+
+
+def read_ledger(ledger_filename):
+    """Read verified copies from a ledger file written by copyJobScript.sh
+
+    Each line is <SRC> <DEST> <DEST size in bytes> <number of events>, separated by tabs.
+    Incomplete lines (e.g. from a job killed mid-write) are ignored,
+    and if a file was copied more than once, the last entry is used.
+
+    Returns
+    -------
+    dict{str:(str, int, int)}
+        {source file: (destination file, size, number of events)}, empty if no ledger
+    """
+    ledger = {}
+    if not os.path.isfile(ledger_filename):
+        return ledger
+    with open(ledger_filename) as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != 4:
+                continue
+            try:
+                ledger[parts[0]] = (parts[1], int(parts[2]), int(parts[3]))
+            except ValueError:
+                continue
+    return ledger
+
+
+def write_ledger(ledger_filename, ledger):
+    """Write ledger dict, see read_ledger()"""
+    with open(ledger_filename, "w") as f:
+        for src, (dest, size, num_events) in ledger.items():
+            f.write("%s\t%s\t%d\t%d\n" % (src, dest, size, num_events))
+
+
+def find_verified_files(filename_mapping, ledger, num_workers=16, max_stat_rate=1000):
+    """Find source files that have already been copied & verified.
+
+    That is, the ledger has a copy to the same destination as in filename_mapping,
+    and the destination still exists with the size it had when verified.
+
+    Parameters
+    ----------
+    filename_mapping : dict{str:str}
+        Dict mapping old to new filenames
+    ledger : dict
+        From read_ledger()
+    num_workers, max_stat_rate : optional
+        For stat-ing destination files, see ntupleStat.StatEngine
+
+    Returns
+    -------
+    set[str]
+        Source filenames
+    """
+    candidates = [src for src, dest in filename_mapping.items()
+                  if src in ledger and ledger[src][0] == dest]
+    verified = set()
+    with StatEngine(num_workers=num_workers, max_rate=max_stat_rate) as stat_engine:
+        for src, result in stat_engine.imap(candidates, key=lambda src: ledger[src][0]):
+            if result.exists and result.size == ledger[src][1]:
+                verified.add(src)
+    return verified
+
+
 def grouper(n, iterable, fillvalue=None):
     """Iterate through iterable in groups of n, padded by fillvalue if too short
 
@@ -286,15 +348,122 @@ def grouper(n, iterable, fillvalue=None):
     return zip_longest(*args, fillvalue=fillvalue)
 
 
-def create_copy_jobs(filename_mapping, num_per_job, log_dir, base_name):
-    """Create Job objects, where each represents a set of files to be copied.
+def get_file_sizes(filenames, num_workers=16, max_stat_rate=1000):
+    """Get size of each file in bytes, stat-ing them concurrently
+
+    Files that cannot be stat-ed have size 0, with a warning.
+
+    Returns
+    -------
+    dict{str:int}
+    """
+    file_sizes = {}
+    missing = []
+    with StatEngine(num_workers=num_workers, max_rate=max_stat_rate) as stat_engine:
+        for filename, result in stat_engine.imap(filenames):
+            file_sizes[filename] = result.size
+            if not result.exists:
+                missing.append(filename)
+    if missing:
+        print("Warning: cannot stat %d source files, assuming they are empty, e.g. %s" % (len(missing), missing[0]))
+    return file_sizes
+
+
+# Rough time to set up a transfer & check the copy, on top of moving the bytes, in seconds
+FILE_OVERHEAD = 30
+
+# When spreading files over jobs by directory, how many of the least-loaded jobs
+# to choose between for each file
+SPREAD_CANDIDATES = 4
+
+
+def estimate_copy_time(size, transfer_rate):
+    """Estimate time to copy & check a file of size bytes, at transfer_rate bytes/s"""
+    return FILE_OVERHEAD + size / float(transfer_rate)
+
+
+def group_files(filenames, num_per_job):
+    """Split files into groups of num_per_job, in order"""
+    return [[f for f in file_group if f] for file_group in grouper(num_per_job, filenames)]
+
+
+def pack_files(filenames, file_sizes, num_per_job, bytes_per_job, job_time, transfer_rate, spread_dirs=False):
+    """Split files into groups that should take about the same time to copy.
+
+    The number of groups is the fewest that keeps each under bytes_per_job,
+    job_time, and num_per_job files on average. Files are then added biggest first,
+    each to the group with the least estimated time so far (skipping full ones),
+    i.e. longest-processing-time-first scheduling.
 
     Parameters
     ----------
-    filename_mapping : dict{str:str}
-        Dict mapping old to new filenames
+    filenames : list[str]
+    file_sizes : dict{str:int}
+        Size of each file in bytes
     num_per_job : int
-        Number of files to rename per job
+        Maximum number of files in a group
+    bytes_per_job : float
+        Target number of bytes per group
+    job_time : float
+        Target time per group, in seconds
+    transfer_rate : float
+        Expected copy speed in bytes/s, see estimate_copy_time()
+    spread_dirs : bool, optional
+        If True, put files from the same directory in different groups where possible,
+        so that jobs running at the same time read from different places.
+        Each file goes to whichever of the SPREAD_CANDIDATES least-loaded groups
+        has fewest files from its directory.
+
+    Returns
+    -------
+    list[list[str]]
+        Groups of filenames, longest estimated time first
+    """
+    if not filenames:
+        return []
+    times = {f: estimate_copy_time(file_sizes.get(f, 0), transfer_rate) for f in filenames}
+    total_bytes = sum(file_sizes.get(f, 0) for f in filenames)
+    num_jobs = max(int(math.ceil(total_bytes / float(bytes_per_job))),
+                   int(math.ceil(sum(times.values()) / float(job_time))),
+                   int(math.ceil(len(filenames) / float(num_per_job))))
+    num_jobs = min(max(num_jobs, 1), len(filenames))
+
+    groups = [[] for _ in range(num_jobs)]
+    group_times = [0.] * num_jobs
+    dir_counts = [Counter() for _ in range(num_jobs)]
+    heap = [(0., i) for i in range(num_jobs)]  # (estimated time, group index) of groups with room
+    num_candidates = SPREAD_CANDIDATES if spread_dirs else 1
+    for filename in sorted(filenames, key=lambda f: (-times[f], f)):
+        candidates = []
+        while heap and len(candidates) < num_candidates:
+            candidates.append(heapq.heappop(heap))
+        dirname = os.path.dirname(filename)
+        best = min(candidates, key=lambda c: (dir_counts[c[1]][dirname], c))
+        for candidate in candidates:
+            if candidate is not best:
+                heapq.heappush(heap, candidate)
+        ind = best[1]
+        groups[ind].append(filename)
+        group_times[ind] += times[filename]
+        dir_counts[ind][dirname] += 1
+        if len(groups[ind]) < num_per_job:
+            heapq.heappush(heap, (group_times[ind], ind))
+
+    order = sorted(range(num_jobs), key=lambda i: -group_times[i])
+    return [groups[i] for i in order if groups[i]]
+
+
+def create_copy_jobs(file_groups, log_dir, base_name):
+    """Create Job objects, where each represents a set of files to be copied.
+
+    Each job is only given the range of lines in the mapping file with its files,
+    so the mapping file must be written in the same order as file_groups,
+    see save_mapping_to_file().
+
+    Parameters
+    ----------
+    file_groups : list[list[str]]
+        Files to copy in each job, from group_files() or pack_files()
     log_dir : str
         Directory for job log
     base_name : str
@@ -305,22 +474,22 @@ def create_copy_jobs(filename_mapping, num_per_job, log_dir, base_name):
     list[Job]
     """
     jobs = []
-    for ind, file_group in enumerate(grouper(num_per_job, filename_mapping.items())):
-        this_file_group = [f for f in file_group if f]
+    start = 0
+    for ind, file_group in enumerate(file_groups):
         this_name = "%s_%d" % (base_name, ind)
         this_args = {
             "logpath": os.path.join(log_dir, "job%d" % (ind)),
-            "scriptargs": " ".join(["%s:%s" % (k, v) for k,v in this_file_group]),
+            "start": start,
+            "end": start + len(file_group),
         }
-        # TODO: check length of args isn't exceeding system maximum
-        # Better yet, just give indices of entries in mapping txt file to use?
-        # print(len(this_args['scriptargs']))
+        start += len(file_group)
         this_job = Job(name=this_name, args=this_args)
         jobs.append(this_job)
     return jobs
 
 
-def write_dag_jobs(dag_filename, status_filename, jobs, initialdir):
+def write_dag_jobs(dag_filename, status_filename, jobs, initialdir, mapping_filename, ledger_filename,
+                   deep_check_percent=0, transfers_per_job=1):
     """Write condor DAG file and job file for all jobs
 
     Parameters
@@ -333,15 +502,30 @@ def write_dag_jobs(dag_filename, status_filename, jobs, initialdir):
         List of Jobs to be run
     initialdir : str
         Location of initial dir with all scripts etc
+    mapping_filename : str
+        Mapping file with the SRC:DEST pairs, the jobs' start & end refer to its lines
+    ledger_filename : str
+        Ledger file for jobs to record verified copies in, see read_ledger().
+        Must be on a filesystem the jobs can write to.
+    deep_check_percent : int, optional
+        Percentage of copies to check by reading every event,
+        on top of comparing checksums & the number of events in the tree header
+    transfers_per_job : int, optional
+        Number of files each job copies at once
     """
     job_filename = dag_filename.replace(".dag", ".job")
     with open(job_filename, 'w') as f:
-        f.write(JOB_TEMPLATE.format(initialdir=initialdir))
+        f.write(JOB_TEMPLATE.format(initialdir=initialdir,
+                                    mapping=os.path.abspath(mapping_filename),
+                                    mapping_name=os.path.basename(mapping_filename),
+                                    ledger=os.path.abspath(ledger_filename),
+                                    deep_check=deep_check_percent,
+                                    transfers=transfers_per_job))
 
     with open(dag_filename, 'w') as f:
         for job in jobs:
             f.write("JOB {name} {job_filename}\n".format(name=job.name, job_filename=job_filename))
-            arg_str = 'logpath="{logpath}" scriptargs="{scriptargs}"'.format(**job.args)
+            arg_str = 'logpath="{logpath}" start="{start}" end="{end}"'.format(**job.args)
             f.write("VARS {name} {args}\n".format(name=job.name, args=arg_str))
         f.write("RETRY ALL_NODES 2 UNLESS-EXIT 111\n")
         f.write("NODE_STATUS_FILE %s 30 ALWAYS-UPDATE\n" % (status_filename))
@@ -359,15 +543,18 @@ def write_new_xml_file(original_xml_filename, new_filename, filename_mapping):
     filename_mapping : dict{str:str}
         Mapping of {original ROOT file : new ROOT file}
     """
+    # Figure out which lines need updating, and with what
+    replacements = {}
+    for entry in iter_xml_entries(original_xml_filename):
+        root_filename = os.path.realpath(entry.path)
+        if root_filename.startswith(("/nfs", "/pnfs")) and not root_filename.startswith(GROUP_DIRECTORY):
+            replacements.setdefault(entry.line_num, []).append((entry.path, filename_mapping[root_filename]))
+
     with open(original_xml_filename) as original_f, open(new_filename, "w") as new_f:
-        for line in original_f:
-            line = line.strip()
-            new_line = line
-            if not line.startswith(("<!--", "-->")):
-                root_filename = extract_root_filename(line)
-                if root_filename.startswith(("/nfs", "/pnfs")) and not root_filename.startswith(GROUP_DIRECTORY):
-                    new_root_filename = filename_mapping[root_filename]
-                    new_line = '<In FileName="%s" Lumi="0.0"/>' % (new_root_filename)
+        for line_num, line in enumerate(original_f, 1):
+            new_line = line.strip()
+            for old_root_filename, new_root_filename in replacements.get(line_num, []):
+                new_line = new_line.replace('"%s"' % old_root_filename, '"%s"' % new_root_filename)
             new_f.write(new_line + "\n")
 
 
@@ -396,9 +583,38 @@ if __name__ == "__main__":
     parser.add_argument("xml", help="XML file to process")
     parser.add_argument("--branch", help="Branch name")
     parser.add_argument("--dryRun", action='store_true', help="Make job files, but don't submit jobs to BIRD")
-    parser.add_argument("--numPerJob", default=50, help="Number of files to move per job", type=int)
+    parser.add_argument("--numPerJob", default=50, help="Maximum number of files to move per job", type=int)
+    parser.add_argument("--bytesPerJob", default=50, type=float,
+                        help="Target amount of data to move per job, in GB")
+    parser.add_argument("--jobTime", default=4, type=float,
+                        help="Target time per job, in hours, using --transferRate and --transfersPerJob. "
+                        "Should be well below the gfal-copy timeout of 8 hours.")
+    parser.add_argument("--transfersPerJob", default=1, type=int,
+                        help="Number of files each job copies at once. "
+                        "A failed copy still fails the job, so the DAG retries it.")
+    parser.add_argument("--transferRate", default=20, type=float,
+                        help="Expected speed of copying a file, in MB/s, to estimate job times")
+    parser.add_argument("--spreadDirs", action='store_true',
+                        help="Spread files from the same directory over different jobs, "
+                        "so running jobs read from different places")
+    parser.add_argument("--noPacking", action='store_true',
+                        help="Don't look at file sizes, just put --numPerJob files in each job")
+    parser.add_argument("--numWorkers", default=16, type=int,
+                        help="Number of source files to stat concurrently")
+    parser.add_argument("--maxStatRate", default=1000, type=float,
+                        help="Maximum number of source & destination files to stat per second. 0 for no limit.")
+    parser.add_argument("--deepCheckPercent", default=0, type=int,
+                        help="Percentage of copied files to also check by reading every event, "
+                        "on top of comparing checksums & number of events")
+    parser.add_argument("--fresh", action='store_true',
+                        help="Copy all files again, ignoring the ledger of files already copied "
+                        "& verified by previous jobs for this XML")
 
     args = parser.parse_args()
+    if not 0 <= args.deepCheckPercent <= 100:
+        parser.error("--deepCheckPercent must be between 0 and 100")
+    if args.transfersPerJob < 1:
+        parser.error("--transfersPerJob must be at least 1")
     print(args)
 
     if not os.path.isfile(args.xml):
@@ -410,6 +626,9 @@ if __name__ == "__main__":
     # Setup job directories
     base_name = os.path.splitext(os.path.basename(args.xml))[0]
     JOB_DIR = os.path.join("jobs", base_name)
+    # Keep the record of files already copied by earlier jobs, before clearing out the job dir
+    ledger_filename = os.path.join(JOB_DIR, LEDGER_FILENAME)
+    ledger = {} if args.fresh else read_ledger(ledger_filename)
     setup_dir(JOB_DIR)
 
     LOG_DIR = os.path.join(JOB_DIR, "logs")
@@ -425,11 +644,45 @@ if __name__ == "__main__":
     # Construct mapping from old names to new
     root_filenames = [f for f in get_root_files_from_xml(args.xml) if not f.startswith(GROUP_DIRECTORY)]
     filename_mapping = create_filename_mapping(root_filenames, branch=args.branch)
-    save_mapping_to_file(filename_mapping, os.path.join(JOB_DIR, "mapping.txt"))
+
+    # Only copy files that haven't been copied & verified already
+    verified = find_verified_files(filename_mapping, ledger, num_workers=args.numWorkers,
+                                   max_stat_rate=args.maxStatRate)
+    write_ledger(ledger_filename, OrderedDict((src, ledger[src]) for src in sorted(verified)))
+    to_copy = [f for f in filename_mapping if f not in verified]
+    if ledger:
+        print("%d files already copied & verified, %d to copy" % (len(verified), len(to_copy)))
+
+    # Split files into jobs, either by size so they take about the same time, or just by number
+    if args.noPacking:
+        file_groups = group_files(to_copy, args.numPerJob)
+    else:
+        file_sizes = get_file_sizes(to_copy, num_workers=args.numWorkers,
+                                    max_stat_rate=args.maxStatRate)
+        transfer_rate = args.transferRate * 1e6
+        file_groups = pack_files(to_copy, file_sizes,
+                                 num_per_job=args.numPerJob,
+                                 bytes_per_job=args.bytesPerJob * 1e9,
+                                 # With several copies at once, a job can do more in the same time
+                                 job_time=args.jobTime * 3600 * args.transfersPerJob,
+                                 transfer_rate=transfer_rate,
+                                 spread_dirs=args.spreadDirs)
+        job_times = [sum(estimate_copy_time(file_sizes[f], transfer_rate) for f in g) / args.transfersPerJob
+                     for g in file_groups]
+        if job_times:
+            print("Moving %.1f GB, estimated job times %.1f - %.1f hours"
+                  % (sum(file_sizes.values()) / 1e9, min(job_times) / 3600, max(job_times) / 3600))
+
+    # Save mapping in job order, so each job's files are together,
+    # followed by those already copied
+    mapping_filename = os.path.join(JOB_DIR, "mapping.txt")
+    save_mapping_to_file(OrderedDict([(f, filename_mapping[f]) for g in file_groups for f in g] +
+                                     [(f, filename_mapping[f]) for f in filename_mapping if f in verified]),
+                         mapping_filename)
 
     # Create jobs that perform a subset of the mappings
-    jobs = create_copy_jobs(filename_mapping=filename_mapping, num_per_job=args.numPerJob, log_dir=LOG_DIR, base_name=base_name)
-    print("Running", len(jobs), "jobs to move", len(root_filenames), "files")
+    jobs = create_copy_jobs(file_groups=file_groups, log_dir=LOG_DIR, base_name=base_name)
+    print("Running", len(jobs), "jobs to move", len(to_copy), "files")
 
     dag_filename = "%s/copyCompress.dag" % (JOB_DIR)
     status_filename = dag_filename + ".status"
@@ -437,9 +690,15 @@ if __name__ == "__main__":
     write_dag_jobs(dag_filename=dag_filename,
                    status_filename=status_filename,
                    jobs=jobs,
-                   initialdir=initial_dir)
-
-    if not args.dryRun:
+                   initialdir=initial_dir,
+                   mapping_filename=mapping_filename,
+                   ledger_filename=ledger_filename,
+                   deep_check_percent=args.deepCheckPercent,
+                   transfers_per_job=args.transfersPerJob)
+
+    if not jobs:
+        print("All files already copied, not submitting any jobs")
+    elif not args.dryRun:
         subprocess.call("condor_submit_dag %s" % dag_filename, shell=True)
         print("Check status with:")
         print("./DAGstatus", status_filename)
@@ -1,12 +1,101 @@
 #!/bin/bash -e
 export LD_LIBRARY_PATH=$LD_LIBRARY_PATH_STORED
 # printenv | sort
-for arg
+
+# Usage:
+# ./htcScript.sh <mapping file> <start> <end> <ledger file (optional)> <deep check % (optional)> <number of transfers at once (optional, default 1)>
+#
+# Copies the SRC:DEST pairs on lines [start, end) of the mapping file,
+# counting lines from 0, i.e. start=0 end=50 is the first 50 lines.
+# Verified copies are recorded in the ledger file, and the deep check % of files
+# are fully read to check them, see copyJobScript.sh
+#
+# Up to the given number of copies run at once, each with its own log,
+# which is printed when it finishes. Once a copy fails no new ones are started.
+# The exit code is 111 (i.e. don't retry) if any copy failed with 111,
+# else that of the first other failed copy, else 0.
+MAPPING="$1"
+START="$2"
+END="$3"
+LEDGER="${4:-}"
+DEEPCHECK="${5:-0}"
+TRANSFERS="${6:-1}"
+
+if [[ ! -f "$MAPPING" ]]; then
+    echo "Cannot find mapping file $MAPPING"
+    exit 111
+fi
+
+NLINES=$(sed -n "$((START+1)),${END}p" "$MAPPING" | wc -l)
+if (( NLINES != END - START )); then
+    echo "Only found $NLINES lines of $((END - START)) in $MAPPING from $START to $END"
+    exit 111
+fi
+
+LOGDIR=$(mktemp -d "${TMPDIR:-/tmp}/copylogs.XXXXXX")
+trap 'rm -rf "$LOGDIR"' EXIT
+
+declare -A RUNNING  # pid : index of copy
+declare -a COPIES  # index : "SRC -> DEST"
+PERMANENT=0  # set if a copy failed with 111
+RETRYCODE=0  # exit code of first other failed copy
+
+# Collect the result of a finished copy
+finish() {
+    local pid=$1
+    local idx=${RUNNING[$pid]}
+    local rc=0
+    wait "$pid" || rc=$?
+    unset "RUNNING[$pid]"
+    echo "=== [$idx] ${COPIES[$idx]}: exit code $rc"
+    cat "$LOGDIR/$idx.log"
+    if (( rc == 111 )); then
+        PERMANENT=1
+    elif (( rc != 0 && RETRYCODE == 0 )); then
+        RETRYCODE=$rc
+    fi
+}
+
+# Wait until fewer than $1 copies are running
+# (polling, since wait -n needs bash >= 4.3)
+reap() {
+    local pid
+    while (( ${#RUNNING[@]} >= $1 )); do
+        for pid in "${!RUNNING[@]}"; do
+            if ! kill -0 "$pid" 2>/dev/null; then
+                finish "$pid"
+            fi
+        done
+        if (( ${#RUNNING[@]} >= $1 )); then
+            sleep 1
+        fi
+    done
+}
+
+# Read from fd 3 so nothing in the loop can eat the mapping lines
+idx=0
+while IFS= read -r arg <&3
 do
-    # each arg is SRC:DEST
+    reap "$TRANSFERS"
+    if (( PERMANENT || RETRYCODE )); then
+        echo "A copy failed, not starting any more"
+        break
+    fi
+    # each line is SRC:DEST
     # echo $arg
     src=${arg%:*}
     dest=${arg#*:}
-    echo "$src -> $dest"
-    ./copyJobScript.sh "$src" "$dest" 1
-done
\ No newline at end of file
+    COPIES[$idx]="$src -> $dest"
+    echo "[$idx] $src -> $dest"
+    ./copyJobScript.sh "$src" "$dest" 1 "$LEDGER" "$DEEPCHECK" > "$LOGDIR/$idx.log" 2>&1 3<&- &
+    RUNNING[$!]=$idx
+    idx=$((idx + 1))
+done 3< <(sed -n "$((START+1)),${END}p" "$MAPPING")
+
+# Wait for the rest
+reap 1
+
+if (( PERMANENT )); then
+    exit 111
+fi
+exit $RETRYCODE
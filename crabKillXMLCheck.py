@@ -16,6 +16,8 @@ import os
 import re
 import argparse
 
+from ntupleXML import iter_xml_entries
+
 
 def get_transferring_job_numbers(crab_log):
     """Get all job numbers that were transferring at the last status check"""
@@ -67,9 +69,16 @@ def create_good_xml(xml_filename, new_xml_filename, bad_ntuple_names):
     if not os.path.isfile(xml_filename):
         raise IOError("Cannot find xml_filename!")
 
+    # Match on the ntuple basename, so that e.g. Ntuple_1.root
+    # doesn't also remove Ntuple_11.root
+    bad_ntuple_names = set(bad_ntuple_names)
+    bad_line_nums = set([entry.line_num
+                         for entry in iter_xml_entries(xml_filename, include_commented=True)
+                         if os.path.basename(entry.path) in bad_ntuple_names])
+
     with open(xml_filename) as inf, open(new_xml_filename, "w") as of:
-        for line in inf:
-            if not any([r in line for r in bad_ntuple_names]):
+        for line_num, line in enumerate(inf, 1):
+            if line_num not in bad_line_nums:
                 of.write(line)  # already has newline at end
 
 
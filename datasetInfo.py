@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 
-"""Loop over XML files, get filenames, look for their info, save to CSV.
+"""Loop over XML files, get filenames, look for their info, save to Parquet/Feather/CSV.
 
 Also saves list of missing ntuples.
 """
@@ -11,14 +11,294 @@ from __future__ import print_function
 
 import os
 import sys
+import json
+import hashlib
 import argparse
 import pandas as pd
 import numpy as np
-from time import sleep
+from array import array
+from itertools import groupby
+from operator import itemgetter
+
+from ntupleXML import iter_xml_entries
+from ntupleStat import StatEngine, add_stat_cache_args, stat_cache_from_args
+from ntupleCatalogue import NtupleCatalogue, get_user_from_filename, get_year_from_dir, get_branch_from_dir
+
+
+# Columns of the output table, in order
+COLUMNS = ["xmldir", "xml", "ntuple", "size", "user", "year"]
+# Columns with few distinct values, stored as categoricals
+CATEGORY_COLUMNS = ["xmldir", "xml", "user", "year"]
+
+# Output table format for each file extension
+TABLE_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".csv": "csv",
+}
+
+
+class NtupleTable(object):
+    """Accumulate ntuple rows in typed column buffers, rather than a list of dicts.
+
+    Sizes go in an array of doubles, and the categorical columns as integer
+    codes into a list of their distinct values, so each row costs little more
+    than its ntuple path. Every chunk_size rows the buffers are moved into
+    numpy arrays, and to_dataframe() joins the chunks at the end.
+    """
+
+    def __init__(self, chunk_size=100000):
+        self.chunk_size = chunk_size
+        self._chunks = []
+        self._num_rows = 0
+        # For each categorical column, value : code, in order of first appearance
+        self._categories = {col: {} for col in CATEGORY_COLUMNS}
+        self._new_buffers()
+
+    def _new_buffers(self):
+        self._ntuples = []
+        self._sizes = array('d')
+        self._codes = {col: array('i') for col in CATEGORY_COLUMNS}
+
+    def __len__(self):
+        return self._num_rows
+
+    def append(self, xmldir, xml, ntuple, size, user, year):
+        """Add one row. size is in MB."""
+        self._ntuples.append(ntuple)
+        self._sizes.append(size)
+        for col, value in (("xmldir", xmldir), ("xml", xml), ("user", user), ("year", year)):
+            if value is None:
+                # Missing value, as in pandas
+                self._codes[col].append(-1)
+                continue
+            categories = self._categories[col]
+            code = categories.get(value)
+            if code is None:
+                code = categories.setdefault(value, len(categories))
+            self._codes[col].append(code)
+        self._num_rows += 1
+        if len(self._ntuples) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        """Move current buffers into a chunk of numpy arrays"""
+        if not self._ntuples:
+            return
+        chunk = {
+            "ntuple": np.array(self._ntuples, dtype=object),
+            "size": np.frombuffer(self._sizes, dtype=np.float64).copy(),
+        }
+        for col in CATEGORY_COLUMNS:
+            chunk[col] = np.frombuffer(self._codes[col], dtype=np.intc).astype(np.int32)
+        self._chunks.append(chunk)
+        self._new_buffers()
+
+    def to_dataframe(self):
+        """Get pandas DataFrame with all rows so far"""
+        self._flush()
+        columns = {}
+        for col in COLUMNS:
+            if self._chunks:
+                values = np.concatenate([chunk[col] for chunk in self._chunks])
+            else:
+                values = np.array([], dtype=np.int32 if col in CATEGORY_COLUMNS else object)
+            if col in CATEGORY_COLUMNS:
+                categories = sorted(self._categories[col], key=self._categories[col].get)
+                values = pd.Categorical.from_codes(values, categories=categories)
+            elif col == "size":
+                values = values.astype(np.float64)
+            columns[col] = values
+        return pd.DataFrame(columns, columns=COLUMNS)
+
+
+def get_table_format(filename):
+    """Get table format ("parquet", "feather" or "csv") from filename extension"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in TABLE_FORMATS:
+        raise ValueError("Don't know how to save %s, use one of these extensions: %s"
+                         % (filename, ", ".join(sorted(TABLE_FORMATS))))
+    return TABLE_FORMATS[ext]
+
+
+def check_table_format(filename):
+    """Check we can write filename's table format, before spending hours getting the data"""
+    fmt = get_table_format(filename)
+    if fmt in ("parquet", "feather"):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            if fmt == "feather":
+                raise ImportError("Writing %s needs pyarrow: pip install pyarrow, or use a .csv filename" % filename)
+            try:
+                import fastparquet  # noqa: F401
+            except ImportError:
+                raise ImportError("Writing %s needs pyarrow or fastparquet: pip install pyarrow, "
+                                  "or use a .csv filename" % filename)
+    return fmt
+
+
+def save_table(df, filename):
+    """Save dataset info DataFrame, format set by filename extension, see TABLE_FORMATS"""
+    fmt = get_table_format(filename)
+    if fmt == "parquet":
+        df.to_parquet(filename, index=False)
+    elif fmt == "feather":
+        df.reset_index(drop=True).to_feather(filename)
+    else:
+        df.to_csv(filename)
+
+
+def load_dataset_info(filename, columns=None):
+    """Load table made by dataset_info(), optionally only some of its columns.
+
+    Parquet & Feather files only read the requested columns from disk,
+    so e.g. a size report can skip the (big) ntuple column.
+
+    Parameters
+    ----------
+    filename : str
+        Parquet, Feather or CSV file
+    columns : list[str], optional
+        Columns to load. Default is all.
+
+    Returns
+    -------
+    pandas.DataFrame
+        With user, year, xmldir & xml as categoricals
+    """
+    fmt = get_table_format(filename)
+    if fmt == "parquet":
+        df = pd.read_parquet(filename, columns=columns)
+    elif fmt == "feather":
+        df = pd.read_feather(filename, columns=columns)
+    else:
+        dtypes = {col: "category" for col in CATEGORY_COLUMNS}
+        if columns:
+            df = pd.read_csv(filename, usecols=columns, dtype=dtypes)[columns]
+        else:
+            df = pd.read_csv(filename, index_col=0, dtype=dtypes)
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and df[col].dtype.name != "category":
+            df[col] = df[col].astype("category")
+    return df
+
+
+# What the storage report can be grouped by. branch is worked out from xmldir.
+REPORT_GROUPS = ["user", "year", "xmldir", "branch"]
+
+
+def _report_keys(df, group):
+    """Get categorical of group values for each row, with missing values as unknown"""
+    if group == "branch":
+        xmldirs = df["xmldir"].astype("category")
+        branches = pd.Categorical([get_branch_from_dir(d, default="unknown")
+                                   for d in xmldirs.cat.categories])
+        codes = xmldirs.cat.codes.values
+        codes = np.where(codes < 0, -1, branches.codes[codes])
+        keys = pd.Categorical.from_codes(codes, categories=branches.categories)
+    else:
+        keys = pd.Categorical(df[group])
+    if pd.isnull(keys).any():
+        keys = keys.add_categories(["unknown"]).fillna("unknown")
+    return keys
+
+
+def make_report(df, group_by=None):
+    """Get storage totals per user, year, etc, counting ntuples used by several XMLs once.
+
+    Ntuples are identified by a 64-bit hash of their path (pandas.util.hash_array),
+    which is much quicker to deduplicate on than the path strings.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Table from dataset_info(), see load_dataset_info(). Needs ntuple & size
+        columns, and the columns to group by (xmldir for branch).
+    group_by : list[str], optional
+        Any of REPORT_GROUPS. Default is all of them.
+
+    Returns
+    -------
+    dict
+        "total": dict of totals over the whole table, and "by_<group>": list of
+        dicts for each group, largest first. "ntuples" & "size" count every row,
+        "unique_ntuples" & "unique_size" each distinct ntuple once.
+        "shared_ntuples" is the number of ntuples in more than 1 XML.
+        Sizes are in GB.
+    """
+    group_by = group_by or REPORT_GROUPS
+    # Paths are nearly all distinct, so don't factorize them first
+    ids = pd.util.hash_array(np.asarray(df["ntuple"], dtype=object), categorize=False)
+    sizes = np.asarray(df["size"], dtype=np.float64) / 1024.  # MB -> GB
+    # Number the distinct ntuples in order of first appearance, so a row is the first
+    # with its ntuple if its number is higher than all before it
+    ntuple_codes, unique_ids = pd.factorize(ids)
+    is_first = ntuple_codes > np.maximum.accumulate(np.concatenate([[-1], ntuple_codes[:-1]]))
+    # Rows whose ntuple is in more than 1 row: usually a small fraction
+    is_shared = np.bincount(ntuple_codes)[ntuple_codes] > 1
+    report = {"total": {
+        "ntuples": int(len(ids)),
+        "unique_ntuples": int(len(unique_ids)),
+        "shared_ntuples": int((is_shared & is_first).sum()),
+        "size": float(sizes.sum()),
+        "unique_size": float(sizes[is_first].sum()),
+    }}
+
+    shared_rows = np.flatnonzero(is_shared)
+    for group in group_by:
+        keys = _report_keys(df, group)
+        codes = keys.codes.astype(np.intp)
+        num_keys = len(keys.categories)
+        # A row is the first with its ntuple in its group if it isn't shared at all,
+        # or it's the first of the shared rows with the same (group, ntuple)
+        first = ~is_shared
+        shared_ids = ntuple_codes[shared_rows].astype(np.int64) * num_keys + codes[shared_rows]
+        first[shared_rows[~pd.Series(shared_ids).duplicated().values]] = True
+        ntuples = np.bincount(codes, minlength=num_keys)
+        size = np.bincount(codes, weights=sizes, minlength=num_keys)
+        unique_ntuples = np.bincount(codes[first], minlength=num_keys)
+        unique_size = np.bincount(codes[first], weights=sizes[first], minlength=num_keys)
+        report["by_" + group] = [
+            {group: str(keys.categories[i]), "ntuples": int(ntuples[i]), "unique_ntuples": int(unique_ntuples[i]),
+             "size": float(size[i]), "unique_size": float(unique_size[i])}
+            for i in np.argsort(-unique_size, kind="mergesort") if ntuples[i]
+        ]
+    return report
+
+
+def print_report(report):
+    """Print report from make_report() as tables"""
+    total = report["total"]
+    print("Total: %d ntuple entries, %d unique ntuples (%d in more than 1 XML)"
+          % (total["ntuples"], total["unique_ntuples"], total["shared_ntuples"]))
+    print("       %.1f GB, %.1f GB counting each ntuple once" % (total["size"], total["unique_size"]))
+    for group in REPORT_GROUPS:
+        rows = report.get("by_" + group)
+        if rows is None:
+            continue
+        width = max([len(group)] + [len(row[group]) for row in rows])
+        print()
+        print("%-*s %10s %10s %12s %12s" % (width, group.capitalize(), "# ntuples", "# unique",
+                                             "Size [GB]", "Unique [GB]"))
+        for row in rows:
+            print("%-*s %10d %10d %12.1f %12.1f" % (width, row[group], row["ntuples"], row["unique_ntuples"],
+                                                   row["size"], row["unique_size"]))
+
+
+def report_columns(group_by=None):
+    """Get table columns needed to make a report grouped by group_by"""
+    columns = ["ntuple", "size"]
+    for group in group_by or REPORT_GROUPS:
+        col = "xmldir" if group == "branch" else group
+        if col not in columns:
+            columns.append(col)
+    return columns
 
 
 def get_ntuple_filenames_from_xml(full_filename):
-    """Yield ntuple filenames from XML file
+    """Yield ntuple filenames from XML file, ignoring commented-out entries
 
     Parameters
     ----------
@@ -30,193 +310,310 @@ def get_ntuple_filenames_from_xml(full_filename):
     generator
         To iterate over filenames
     """
-    with open(full_filename) as f:
-        is_comment = False
-        for line in f:
-            if line.startswith("<!--"):
-                is_comment = True
-            if line.endswith("-->"):
-                is_comment = False
-            if is_comment:
-                continue
-            if line.startswith("<In FileName="):
-                this_line = line.strip()
-                this_line = this_line.replace('<In FileName="', '')
-                this_line = this_line.replace('" Lumi="0.0"/>', '')
-                yield this_line
+    for entry in iter_xml_entries(full_filename):
+        yield entry.path
+
+
+def find_xml_files(top_directory):
+    """Get relative paths of XML files in a directory, looking recursively.
+
+    Parameters
+    ----------
+    top_directory : str
+
+    Returns
+    -------
+    list[str]
+        In os.walk() order
+    """
+    xml_rel_paths = []
+    for (dirpath, dirnames, filenames) in os.walk(top_directory):
+        print("Looking in", dirpath)
+        for filename in filenames:
+            full_filename = os.path.join(dirpath, filename)
+            xml_rel_paths.append(os.path.relpath(full_filename, top_directory))
+    return xml_rel_paths
 
 
-def get_ntuples_from_xml_files(top_directory):
+def get_ntuples_from_xml_files(top_directory, xml_rel_paths=None):
     """Get iterator over ntuples in XML files in a directory.
     Looks recursively through directories for XML files.
 
     Parameters
     ----------
     top_directory : str
+    xml_rel_paths : list[str], optional
+        Only look at these XML files (relative to top_directory)
 
     Yields
     ------
     (str, iterator)
         Returns (relative path of XML file, ntuple filename iterator)
     """
-    for (dirpath, dirnames, filenames) in os.walk(top_directory):
-        print("Looking in", dirpath)
-        for filename in filenames:
-            full_filename = os.path.join(dirpath, filename)
-            rel_path = os.path.relpath(full_filename, top_directory)
-            ntuple_iter = get_ntuple_filenames_from_xml(full_filename)
-            yield rel_path, ntuple_iter
+    if xml_rel_paths is None:
+        xml_rel_paths = find_xml_files(top_directory)
+    for rel_path in xml_rel_paths:
+        full_filename = os.path.join(top_directory, rel_path)
+        ntuple_iter = get_ntuple_filenames_from_xml(full_filename)
+        yield rel_path, ntuple_iter
 
 
-def get_user_from_filename(ntuple_filename):
-    """Get username from full filepath
+def get_catalogue_branch(xml_rel_path, top_dir, branch=None):
+    """Get branch name to use in catalogue for XML: branch if set, else the RunII_* part of its path,
+    else the name of top_dir"""
+    return branch or get_branch_from_dir(xml_rel_path, default=os.path.basename(top_dir))
 
-    Assumes it comes after .../user/
-    e.g. :
-    get_user_from_filename("/nfs/dust/cms/user/robin/UHH2/Ntuple_2016v2.root")
-    >> robin
+
+def get_all_data(top_dir, stat_engine, catalogue=None, branch=None, xml_rel_paths=None):
+    """Get all Ntuple data
 
     Parameters
     ----------
-    ntuple_filename : str
+    top_dir : str
+        Parent directory to look for XML files
+    stat_engine : ntupleStat.StatEngine
+        To check existence & size of ntuples
+    catalogue : ntupleCatalogue.NtupleCatalogue, optional
+        If set, also store XMLs & ntuples in this catalogue
+    branch : str, optional
+        Branch name to use in catalogue. If not set, it is taken from the
+        RunII_* part of the XML path, or else the name of top_dir.
+    xml_rel_paths : list[str], optional
+        Only look at these XML files (relative to top_dir). Default is all.
 
     Returns
     -------
-    str
-        Username, or None if not found
+    NtupleTable
+        Ntuple info, for ntuples that exist
+    dict
+        XML relative path : {"num_ntuples": number of ntuples, "missing": list of missing ntuples},
+        for each XML with ntuples
     """
-    if "/user/" not in ntuple_filename:
-        return None
-    ntuple_filename = ntuple_filename.replace("//", "/")
-    parts = ntuple_filename.split("/")
-    ind = parts.index("user")
-    if ind == len(parts)-1:
-        return None
-    return parts[ind+1]
+    data = NtupleTable()
+    xml_missing = {}
+    top_dir = os.path.abspath(top_dir)
+    # Flatten to one stream of (xml, ntuple) so the stat engine can keep
+    # its workers busy across XML boundaries. Results come back in order.
+    xml_ntuples = ((xml_rel_path, ntuple_filename)
+                   for xml_rel_path, ntuple_iter in get_ntuples_from_xml_files(top_dir, xml_rel_paths)
+                   for ntuple_filename in ntuple_iter)
+    stat_results = stat_engine.imap(xml_ntuples, key=itemgetter(1))
+    for xml_rel_path, xml_results in groupby(stat_results, key=lambda x: x[0][0]):
+        this_counter = 0  # count files in this xml
+        missing = []  # missing files in this xml
+        year = get_year_from_dir(xml_rel_path)
+        xmldir = os.path.dirname(xml_rel_path)
+        xml_ntuples = []
+        for (_, ntuple_filename), stat_result in xml_results:
+
+            this_counter += 1
+            if catalogue:
+                xml_ntuples.append((ntuple_filename, stat_result))
+
+            if not stat_result.exists:
+                missing.append(ntuple_filename)
+                continue
 
+            user = get_user_from_filename(ntuple_filename)
+            size = stat_result.size / (1024.0 * 1024.0)  # to MBytes
+            data.append(xmldir=xmldir, xml=xml_rel_path, ntuple=ntuple_filename, size=size, user=user, year=year)
 
-def get_year_from_dir(dirname):
-    """Get dataset year from XML filepath.
+        if catalogue:
+            catalogue.add_xml(get_catalogue_branch(xml_rel_path, top_dir, branch), xml_rel_path, year, xml_ntuples)
 
-    Assumes it comes after RunII_*, or is the first part
-    e.g.
-    get_year_from_dir("../common/dataset/RunII_102X_v1/2017v2/MC_TTbar.xml")
-    >> "2017v2"
+        xml_missing[xml_rel_path] = {"num_ntuples": this_counter, "missing": missing}
+        if missing:
+            if len(missing) == this_counter:
+                print("All ntuples in", xml_rel_path, "are missing")
+            else:
+                print("Some but not all ntuples in", xml_rel_path, "are missing")
+    stat_engine.print_report()
+    return data, xml_missing
+
+
+def write_missing_files(missing_filename, xml_rel_paths, xml_states):
+    """Write list of missing ntuples per XML, and list of XMLs with all ntuples missing.
 
     Parameters
     ----------
-    dirname : str
-
-    Returns
-    -------
-    str
-        Year, or None if not found
+    missing_filename : str
+        Name for output missing ntuple file. The list of XMLs with all ntuples
+        missing goes in <missing_filename stem>_all.txt
+    xml_rel_paths : list[str]
+        XMLs, in the order to write them
+    xml_states : dict
+        XML : dict with "num_ntuples" & "missing" keys, see get_all_data()
     """
-    parts = dirname.split("/")
-    branch = "RunII_"
-    for p in parts:
-        if branch in p:
-            ind = parts.index(p)
-            if ind == len(parts)-1:
-                return None
-            return parts[ind+1]
-    else:
-        return parts[0]
+    print("Saving missing file info to", missing_filename)
+    missing_filename_all = os.path.splitext(missing_filename)[0]+"_all"+os.path.splitext(missing_filename)[1]
+    print("Saving completelmy missing file info to", missing_filename_all)
+    with open(missing_filename, "w") as f_missing, open(missing_filename_all, "w") as f_missing_all:
+        for xml_rel_path in xml_rel_paths:
+            state = xml_states.get(xml_rel_path, {})
+            missing = state.get("missing")
+            if not missing:
+                continue
+            # Print XML filename first so easier to track down
+            f_missing.write("-"*10 + "\n")
+            f_missing.write("%s\n" % xml_rel_path)
+            f_missing.write("-"*10 + "\n")
+            for ntuple_filename in missing:
+                f_missing.write(ntuple_filename)
+                f_missing.write("\n")
+            if len(missing) == state["num_ntuples"]:
+                f_missing_all.write(xml_rel_path+"\n")
 
 
-def get_all_data(top_dir, missing_filename):
-    """Get all Ntuple data
+def get_file_hash(filename):
+    """Get SHA1 hex digest of file contents"""
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def check_xml_files(top_dir, xml_rel_paths, old_states):
+    """Find XMLs that are new or changed since the states in old_states were recorded.
+
+    An XML is unchanged if its mtime & size are the same as before, or if they
+    differ but its contents hash is the same (e.g. it was touched or re-checked-out).
 
     Parameters
     ----------
     top_dir : str
-        Parent directory to look for XML files
-    missing_filename : str
-        Name for output missing ntuple file
+    xml_rel_paths : list[str]
+    old_states : dict
+        XML relative path : dict with "mtime", "size", "sha1" keys,
+        plus anything else to be carried over for unchanged XMLs
 
     Returns
     -------
-    list[dict]
-        List of ntuple info, each entry is a dict
+    dict
+        XML relative path : state dict, with "mtime", "size", "sha1" updated.
+        For unchanged XMLs, the other keys of old_states are kept.
+    list[str]
+        New or changed XMLs
     """
-    data = []
-    # Save missing file info to separate file
-    print("Saving missing file info to", missing_filename)
-    missing_filename_all = os.path.splitext(missing_filename)[0]+"_all"+os.path.splitext(missing_filename)[1]
-    print("Saving completelmy missing file info to", missing_filename_all)
-    with open(missing_filename, "w") as f_missing, open(missing_filename_all, "w") as f_missing_all:
-        top_dir = os.path.abspath(top_dir)
-        counter = 0  # count global num files
-        for ind, (xml_rel_path, ntuple_iter) in enumerate(get_ntuples_from_xml_files(top_dir)):
-            first_time = True
-
-            this_counter = 0  # count files in this xml
-            missing_counter = 0  # count missing files in this xml
-            for ntuple_filename in ntuple_iter:
-
-                this_counter += 1
-                counter += 1 
-
-                if not os.path.isfile(ntuple_filename):
-                    if first_time:
-                        # If it's the first time we encounter this file,
-                        # print it's filename so easier to track down
-                        f_missing.write("-"*10 + "\n")
-                        f_missing.write("%s\n" % xml_rel_path)
-                        f_missing.write("-"*10 + "\n")
-                        first_time = False
-                    f_missing.write(ntuple_filename)
-                    f_missing.write("\n")
-                    missing_counter += 1
-                    continue
-
-                # size = np.random.random() * 100  # dummy data for testing
-                user = get_user_from_filename(ntuple_filename)
-                size = os.path.getsize(ntuple_filename) / (1024.0 * 1024.0)  # to MBytes
-                year = get_year_from_dir(xml_rel_path)
-                data.append({
-                    "xmldir": os.path.dirname(xml_rel_path),
-                    "ntuple": ntuple_filename,
-                    "size": size,
-                    "user": user,
-                    "year": year,
-                })
-
-                # Sleep every so often to avoid too much stress on filesystem
-                if counter % 5000 == 0:
-                    print("Done", counter, ", sleeping for 5s...")
-                    sleep(5)
-            
-            if missing_counter > 0:
-                if missing_counter == this_counter:
-                    f_missing_all.write(xml_rel_path+"\n")
-                    print("All ntuples in", xml_rel_path, "are missing")
-                else:
-                    print("Some but not all ntuples in", xml_rel_path, "are missing")
-    return data
-
-
-def dataset_info(top_dir, csv_filename):
-    """Go through all XML files recursively from top_dir, get file info, save to CSV.
+    states = {}
+    changed = []
+    for xml_rel_path in xml_rel_paths:
+        st = os.stat(os.path.join(top_dir, xml_rel_path))
+        old_state = old_states.get(xml_rel_path)
+        if old_state and old_state["mtime"] == st.st_mtime and old_state["size"] == st.st_size:
+            states[xml_rel_path] = old_state
+            continue
+        state = {"mtime": st.st_mtime, "size": st.st_size,
+                 "sha1": get_file_hash(os.path.join(top_dir, xml_rel_path))}
+        if old_state and old_state["sha1"] == state["sha1"]:
+            old_state.update(state)
+            states[xml_rel_path] = old_state
+            continue
+        states[xml_rel_path] = state
+        changed.append(xml_rel_path)
+    return states, changed
+
+
+def load_previous_run(output_filename, state_filename, top_dir):
+    """Load table & XML states from the last run, if they can be used for an incremental run.
+
+    Returns
+    -------
+    pandas.DataFrame or None
+    dict
+        XML relative path : state, see check_xml_files(). Empty if no usable previous run.
+    """
+    if not os.path.isfile(output_filename) or not os.path.isfile(state_filename):
+        print("No previous output and/or", state_filename, "- doing full run")
+        return None, {}
+    with open(state_filename) as f:
+        state = json.load(f)
+    if state.get("top_dir") != top_dir:
+        print("Previous run was over", state.get("top_dir"), "not", top_dir, "- doing full run")
+        return None, {}
+    df = load_dataset_info(output_filename)
+    if "xml" not in df.columns:
+        print("Previous output has no xml column - doing full run")
+        return None, {}
+    return df, state["xmls"]
+
+
+def merge_tables(old_df, new_df, xml_rel_paths):
+    """Combine tables, with rows ordered by XML as in xml_rel_paths"""
+    df = pd.concat([old_df, new_df], ignore_index=True)
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype("category")
+    xml_order = pd.Series(np.arange(len(xml_rel_paths)), index=xml_rel_paths)
+    order = xml_order.reindex(df["xml"].astype(object)).values
+    df = df.iloc[np.argsort(order, kind="mergesort")]
+    return df.reset_index(drop=True)
+
+
+def dataset_info(top_dir, output_filename, num_workers=16, max_stat_rate=1000, stat_cache=None,
+                 catalogue=None, branch=None, incremental=False):
+    """Go through all XML files recursively from top_dir, get file info, save to table.
 
     Parameters
     ----------
     top_dir : str
         Parent directory to look for XML files
-    csv_filename : str
-        Output CSV filename to use. Also used as template for missing filename.
+    output_filename : str
+        Output filename to use, format set by extension: .parquet, .feather or .csv.
+        Also used as template for missing & XML state filenames.
+    num_workers : int, optional
+        Number of files to stat concurrently
+    max_stat_rate : float, optional
+        Maximum number of files to stat per second, to avoid stressing the
+        filesystem. 0 for no limit.
+    stat_cache : ntupleStat.StatCache, optional
+        Cache of stat results from previous runs
+    catalogue : ntupleCatalogue.NtupleCatalogue, optional
+        Catalogue to also store results in
+    branch : str, optional
+        Branch name for catalogue, see get_all_data()
+    incremental : bool, optional
+        If True, reuse the previous output_filename, and only look at the
+        XMLs that have changed since then. Their state is kept in
+        <output_filename stem>_xmls.json.
     """
+    check_table_format(output_filename)
+    top_dir = os.path.abspath(top_dir)
+
     # To save missing file info to separate file
-    missing_file = os.path.splitext(csv_filename)[0]
-    missing_file = missing_file + "_missing.txt"
-    data = get_all_data(top_dir=top_dir, missing_filename=missing_file)
-    print("Saving to dataframe & CSV...")
+    stem = os.path.splitext(output_filename)[0]
+    missing_file = stem + "_missing.txt"
+    state_file = stem + "_xmls.json"
+
+    xml_rel_paths = find_xml_files(top_dir)
+    old_df, old_states = None, {}
+    if incremental:
+        old_df, old_states = load_previous_run(output_filename, state_file, top_dir)
+    xml_states, changed = check_xml_files(top_dir, xml_rel_paths, old_states)
+    print(len(changed), "of", len(xml_rel_paths), "XMLs are new or changed")
+
+    with StatEngine(num_workers=num_workers, max_rate=max_stat_rate, cache=stat_cache) as stat_engine:
+        data, xml_missing = get_all_data(top_dir=top_dir, stat_engine=stat_engine,
+                                         catalogue=catalogue, branch=branch, xml_rel_paths=changed)
+    for xml_rel_path in changed:
+        xml_states[xml_rel_path].update(xml_missing.get(xml_rel_path, {"num_ntuples": 0, "missing": []}))
+
+    write_missing_files(missing_file, xml_rel_paths, xml_states)
+
+    if catalogue:
+        catalogue_xmls = {}  # branch : list of XML paths
+        for xml_rel_path in xml_rel_paths:
+            catalogue_xmls.setdefault(get_catalogue_branch(xml_rel_path, top_dir, branch), []).append(xml_rel_path)
+        for this_branch, xml_paths in catalogue_xmls.items():
+            catalogue.prune(this_branch, xml_paths)
+        print("Catalogue updated:", catalogue.filename)
+
+    print("Saving to dataframe & %s..." % output_filename)
 
     # Convert to pandas dataframe, makes life easier
-    df = pd.DataFrame(data)
-    df['user'] = df['user'].astype('category')
-    df['xmldir'] = df['xmldir'].astype('category')
-    df['year'] = df['year'].astype('category')
+    df = data.to_dataframe()
+    if old_df is not None:
+        unchanged = old_df["xml"].isin(set(xml_rel_paths) - set(changed))
+        df = merge_tables(old_df[unchanged.values], df, xml_rel_paths)
 
     # Print out bits of dataframe to check sane
     print(df.head())
@@ -229,26 +626,82 @@ def dataset_info(top_dir, csv_filename):
     print(df.memory_usage(deep=True))
     print(len(df.index), "entries in dataframe")
 
-    # Save it to CSV
-    df.to_csv(csv_filename)
+    save_table(df, output_filename)
+    # Only save XML states once the table is safely written
+    with open(state_file, "w") as f:
+        json.dump({"top_dir": top_dir, "xmls": xml_states}, f)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("topDir",
+                        nargs="?",
                         help="Top directory to look for XML files. "
-                        "All subdirectories will be included, recursively.")
-    parser.add_argument("--csv",
+                        "All subdirectories will be included, recursively. "
+                        "Can be left out with --report, to only report on the existing output.")
+    parser.add_argument("--output", "--csv",
                         default="datasetinfo.csv",
-                        help="Input/output CSV file.")
+                        help="Output file. Format is set by the extension: "
+                        ".csv, or .parquet/.feather (both need pyarrow), "
+                        "which are smaller & faster to read back.")
+    parser.add_argument("--numWorkers",
+                        default=16, type=int,
+                        help="Number of ntuples to stat concurrently.")
+    parser.add_argument("--maxStatRate",
+                        default=1000, type=float,
+                        help="Maximum number of ntuples to stat per second, "
+                        "to avoid stressing the filesystem. 0 for no limit.")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Reuse the previous output, and only look at XMLs that are new "
+                        "or have changed since then (by mtime & contents hash).")
+    parser.add_argument("--report",
+                        action="store_true",
+                        help="Print storage totals from the output table, "
+                        "counting ntuples used by several XMLs once.")
+    parser.add_argument("--reportBy",
+                        nargs="+", choices=REPORT_GROUPS, default=REPORT_GROUPS,
+                        help="What to group the report by.")
+    parser.add_argument("--reportFormat",
+                        choices=["table", "json"], default="table",
+                        help="Print report as tables, or as JSON.")
+    add_stat_cache_args(parser)
+    parser.add_argument("--catalogue",
+                        help="Also add results to this SQLite ntuple catalogue, "
+                        "see ntupleCatalogue.py")
+    parser.add_argument("--branch",
+                        help="Branch name to use in the catalogue. "
+                        "Default is the RunII_* part of each XML path, or else the name of topDir.")
     args = parser.parse_args()
 
-    if not os.path.isdir(args.topDir):
-        raise IOError("%s does not exist" % args.topDir)
-
-    csv_dir = os.path.dirname(os.path.abspath(args.csv))
-    if not os.path.isdir(csv_dir):
-        os.path.makedirs(csv_dir)
-
-    dataset_info(top_dir=args.topDir, csv_filename=args.csv)
+    if not args.topDir and not args.report:
+        parser.error("topDir is required unless using --report")
+
+    if args.topDir:
+        if not os.path.isdir(args.topDir):
+            raise IOError("%s does not exist" % args.topDir)
+
+        check_table_format(args.output)
+        output_dir = os.path.dirname(os.path.abspath(args.output))
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        stat_cache = stat_cache_from_args(args)
+        catalogue = NtupleCatalogue(args.catalogue) if args.catalogue else None
+        dataset_info(top_dir=args.topDir, output_filename=args.output,
+                     num_workers=args.numWorkers, max_stat_rate=args.maxStatRate,
+                     stat_cache=stat_cache, catalogue=catalogue, branch=args.branch,
+                     incremental=args.incremental)
+        if stat_cache:
+            stat_cache.close()
+        if catalogue:
+            catalogue.close()
+
+    if args.report:
+        report = make_report(load_dataset_info(args.output, columns=report_columns(args.reportBy)),
+                             group_by=args.reportBy)
+        if args.reportFormat == "json":
+            print(json.dumps(report, indent=2))
+        else:
+            print_report(report)
     sys.exit(0)
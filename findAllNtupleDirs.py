@@ -18,11 +18,20 @@ copy of the UHH2-datasets repository.
 
 from __future__ import print_function
 import os
-import re
 import sys
 import subprocess
 import uuid
 import shutil
+import argparse
+import sqlite3
+import itertools
+import threading
+import multiprocessing
+from collections import namedtuple
+
+from ntupleXML import get_ntuple_filenames, iter_entries
+from ntupleStat import StatEngine, StatCache, add_stat_cache_args, stat_cache_from_args
+from ntupleCatalogue import NtupleCatalogue, get_year_from_dir, remove_crab_dir
 
 if not hasattr(subprocess, 'check_output'):
     raise ImportError("subprocess module missing check_output(): you need python 2.7 or newer")
@@ -45,6 +54,9 @@ LEGACY_BRANCHES = [
 # Set this to the remote name that will be used for the central UHH2 repo
 REMOTE_NAME = "UHH"
 
+# Where to read UHH2-datasets releases from with --gitObjects
+DATASETS_REF = REMOTE_NAME + "/master"
+
 
 def init_repo(repo_url, clone_dir):
     if os.path.isdir(clone_dir):
@@ -97,26 +109,302 @@ def find_xml_files(start='common/datasets'):
 
 
 def get_root_files_from_xml(xml_filename):
-    root_filenames = []
-    with open(xml_filename) as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith(("<!--", "-->")):
-                continue
-            this_line = line.replace('<In FileName="', '').replace('" Lumi="0.0"/>', '')
-            if this_line.startswith(("/nfs", "/pnfs")):
-                root_filenames.append(this_line)
-    return root_filenames
-
-
-def remove_crab_dir(dirname):
-    """If dir path ends with e.g. 0001 added by crab, remove it"""
-    dirname = dirname.rstrip("/")  # a trailing / will screw up basename
-    last_dir = os.path.basename(dirname)
-    if re.match(r'^\d\d\d\d$', last_dir):
-        return os.path.dirname(dirname)
+    return get_ntuple_filenames(xml_filename, prefixes=("/nfs", "/pnfs"))
+
+
+def list_xml_blobs(ref, start):
+    """List XML files under start in git ref, without checking it out.
+
+    Returns
+    -------
+    list[(str, str)]
+        (XML filepath, blob SHA) for each XML
+    """
+    out = subprocess.check_output(["git", "ls-tree", "-r", "-z", "--full-tree", ref, "--", start])
+    blobs = []
+    for entry in out.decode().split("\0"):
+        if not entry:
+            continue
+        info, filename = entry.split("\t", 1)
+        mode, obj_type, sha = info.split()
+        if obj_type == "blob" and os.path.splitext(filename)[1] == ".xml":
+            blobs.append((filename, sha))
+    return blobs
+
+
+def get_commit_sha(ref):
+    """Get full SHA of commit that ref points to"""
+    return subprocess.check_output(["git", "rev-parse", ref + "^{commit}"]).decode().strip()
+
+
+def commit_exists(sha):
+    """Check if commit is in the repo, e.g. it may have gone after a force-push"""
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call(["git", "cat-file", "-e", sha + "^{commit}"], stderr=devnull) == 0
+
+
+def diff_xml_blobs(old_commit, new_commit, start):
+    """Get XML files under start that changed between two commits.
+
+    Returns
+    -------
+    dict[str, str]
+        XML filepath : new blob SHA, or None if the XML was deleted
+    """
+    out = subprocess.check_output(["git", "diff", "--raw", "-z", "--no-renames", "--no-abbrev",
+                                   old_commit, new_commit, "--", start])
+    parts = out.decode().split("\0")
+    changes = {}
+    # Output alternates between ":oldmode newmode oldsha newsha status" and filepath
+    for info, filename in zip(parts[0::2], parts[1::2]):
+        if os.path.splitext(filename)[1] != ".xml":
+            continue
+        new_sha, status = info.split()[3:5]
+        changes[filename] = None if status == "D" else new_sha
+    return changes
+
+
+def iter_blob_contents(shas):
+    """Stream contents of git blobs using one git cat-file --batch process.
+
+    Yields
+    ------
+    (str, str)
+        (blob SHA, contents)
+    """
+    proc = subprocess.Popen(["git", "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # Feed SHAs in another thread, so neither pipe fills up & blocks
+    def feed():
+        for sha in shas:
+            proc.stdin.write((sha + "\n").encode())
+        proc.stdin.close()
+    writer = threading.Thread(target=feed)
+    writer.daemon = True
+    writer.start()
+
+    for sha in shas:
+        header = proc.stdout.readline().decode().split()
+        if len(header) != 3:
+            raise RuntimeError("Cannot read git blob %s: %s" % (sha, " ".join(header)))
+        contents = proc.stdout.read(int(header[2]))
+        proc.stdout.read(1)  # newline after each blob
+        yield header[0], contents.decode("utf-8", "replace")
+    writer.join()
+    proc.wait()
+
+
+class BlobCache(object):
+    """SQLite store of the ntuples in each XML git blob, keyed by blob SHA.
+
+    Since a blob SHA only depends on its contents, an XML that is the same
+    in several branches, or unchanged since an earlier run, is only parsed once.
+
+    Also stores the last commit scanned for each branch/release, with the
+    blob SHA of each of its XMLs, for incremental runs. Alongside are the
+    outputs for that commit: how many XMLs use each ntuple, and which XMLs
+    use each ntuple directory. These are patched with only the changed XMLs,
+    so an incremental run doesn't need the ntuples of the unchanged ones.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, ntuples TEXT);
+        CREATE TABLE IF NOT EXISTS scans (name TEXT PRIMARY KEY, start TEXT, commit_sha TEXT);
+        CREATE TABLE IF NOT EXISTS scan_xmls (name TEXT, path TEXT, sha TEXT, PRIMARY KEY (name, path));
+        CREATE TABLE IF NOT EXISTS scan_ntuples (name TEXT, path TEXT, num_xmls INTEGER,
+                                                 PRIMARY KEY (name, path));
+        CREATE TABLE IF NOT EXISTS scan_dirs (name TEXT, xml TEXT, dir TEXT, PRIMARY KEY (name, xml, dir));
+        CREATE INDEX IF NOT EXISTS scan_dirs_by_dir ON scan_dirs (name, dir, xml);
+    """
+
+    # Stay below SQLite's default limit of 999 parameters per query
+    MAX_QUERY_PARAMS = 500
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Several processes may share the cache, so wait for each other's writes
+        self._conn = sqlite3.connect(filename, timeout=600)
+        self._conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def get_many(self, shas):
+        """Get {blob SHA: list of ntuples} for the blobs in shas seen before"""
+        shas = list(shas)
+        found = {}
+        for i in range(0, len(shas), self.MAX_QUERY_PARAMS):
+            chunk = shas[i:i + self.MAX_QUERY_PARAMS]
+            query = "SELECT sha, ntuples FROM blobs WHERE sha IN (%s)" % ", ".join("?" * len(chunk))
+            for sha, ntuples in self._conn.execute(query, chunk):
+                found[sha] = ntuples.split("\n") if ntuples else []
+        return found
+
+    def put(self, sha, root_files):
+        self._conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)", (sha, "\n".join(root_files)))
+
+    def commit(self):
+        self._conn.commit()
+
+    def get_scan(self, name, start):
+        """Get last commit scanned for branch/release, and {XML path: blob SHA} at that commit.
+
+        Returns (None, {}) if never scanned (with the same start directory),
+        or if the outputs weren't stored with it (caches from before they were).
+        """
+        row = self._conn.execute("SELECT commit_sha FROM scans WHERE name = ? AND start = ?",
+                                 (name, start)).fetchone()
+        if row is None:
+            return None, {}
+        xml_shas = dict(self._conn.execute("SELECT path, sha FROM scan_xmls WHERE name = ?", (name,)))
+        has_outputs = self._conn.execute("SELECT 1 FROM scan_dirs WHERE name = ? LIMIT 1", (name,)).fetchone()
+        if xml_shas and not has_outputs:
+            return None, {}
+        return row[0], xml_shas
+
+    def set_scan(self, name, start, commit_sha, xml_shas, root_files):
+        """Store commit scanned for branch/release, and its XMLs & their ntuples from scratch.
+
+        Parameters
+        ----------
+        name, start, commit_sha : str
+        xml_shas : dict[str, str]
+            {XML path: blob SHA}
+        root_files : dict[str, list[str]]
+            {blob SHA: ntuples}
+        """
+        self._conn.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?)", (name, start, commit_sha))
+        for table in ("scan_xmls", "scan_ntuples", "scan_dirs"):
+            self._conn.execute("DELETE FROM %s WHERE name = ?" % table, (name,))
+        self._conn.executemany("INSERT INTO scan_xmls VALUES (?, ?, ?)",
+                               [(name, path, sha) for path, sha in xml_shas.items()])
+        num_xmls = {}
+        for sha in xml_shas.values():
+            for rf in set(root_files[sha]):
+                num_xmls[rf] = num_xmls.get(rf, 0) + 1
+        self._conn.executemany("INSERT INTO scan_ntuples VALUES (?, ?, ?)",
+                               [(name, rf, n) for rf, n in num_xmls.items()])
+        self._conn.executemany("INSERT INTO scan_dirs VALUES (?, ?, ?)",
+                               [(name, path, rd) for path, sha in xml_shas.items()
+                                for rd in get_ntuple_dirs(root_files[sha])])
+        self._conn.commit()
+
+    def update_scan(self, name, commit_sha, removed, added):
+        """Patch the stored scan of branch/release with the XMLs changed since the last commit.
+
+        Parameters
+        ----------
+        name, commit_sha : str
+        removed : list[(str, list[str])]
+            (XML path, ntuples) for the old versions of XMLs that were changed or deleted
+        added : list[(str, str, list[str])]
+            (XML path, blob SHA, ntuples) for the new versions of XMLs that were added or changed
+        """
+        self._conn.execute("UPDATE scans SET commit_sha = ? WHERE name = ?", (commit_sha, name))
+        for path, rfl in removed:
+            self._conn.execute("DELETE FROM scan_xmls WHERE name = ? AND path = ?", (name, path))
+            self._conn.execute("DELETE FROM scan_dirs WHERE name = ? AND xml = ?", (name, path))
+            rfl = [(name, rf) for rf in set(rfl)]
+            self._conn.executemany("UPDATE scan_ntuples SET num_xmls = num_xmls - 1 WHERE name = ? AND path = ?",
+                                   rfl)
+            self._conn.executemany("DELETE FROM scan_ntuples WHERE name = ? AND path = ? AND num_xmls <= 0", rfl)
+        for path, sha, rfl in added:
+            self._conn.execute("INSERT INTO scan_xmls VALUES (?, ?, ?)", (name, path, sha))
+            self._conn.executemany("INSERT INTO scan_dirs VALUES (?, ?, ?)",
+                                   [(name, path, rd) for rd in get_ntuple_dirs(rfl)])
+            rfl = [(name, rf) for rf in set(rfl)]
+            self._conn.executemany("INSERT OR IGNORE INTO scan_ntuples VALUES (?, ?, 0)", rfl)
+            self._conn.executemany("UPDATE scan_ntuples SET num_xmls = num_xmls + 1 WHERE name = ? AND path = ?",
+                                   rfl)
+        self._conn.commit()
+
+    def get_scan_ntuples(self, name):
+        """Get sorted list of all ntuples in the stored scan of branch/release"""
+        return [row[0] for row in
+                self._conn.execute("SELECT path FROM scan_ntuples WHERE name = ? ORDER BY path", (name,))]
+
+    def iter_scan_dir_map(self, name):
+        """Yield (ntuple directory, sorted list of XMLs using it) from the stored scan, sorted by directory"""
+        rows = self._conn.execute("SELECT dir, xml FROM scan_dirs WHERE name = ? ORDER BY dir, xml", (name,))
+        for rd, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield rd, [xml for _, xml in group]
+
+
+def get_root_files_from_git(ref, start, blob_cache=None, name=None, want_lists=True):
+    """Get ntuples in all XML files under start in git ref, straight from git objects.
+
+    Doesn't touch the working tree. Only blobs not already in blob_cache are read & parsed.
+
+    If name is set (requires blob_cache), the run is incremental: only the XMLs
+    changed since the commit last scanned for name are looked at, and used to
+    patch the scan stored in blob_cache, see BlobCache.update_scan().
+
+    Parameters
+    ----------
+    ref, start : str
+    blob_cache : BlobCache, optional
+    name : str, optional
+    want_lists : bool, optional
+        If False with an incremental run, don't load the ntuples of unchanged XMLs,
+        and return None instead of the lists of ntuples. The outputs can then be
+        made from the stored scan instead.
+
+    Returns
+    -------
+    list[str], list[list[str]] or None
+        XML filepaths, and list of ntuples for each
+    """
+    xml_shas = None
+    changes = None
+    if name and blob_cache:
+        commit = get_commit_sha(ref)
+        last_commit, last_xml_shas = blob_cache.get_scan(name, start)
+        if last_commit == commit:
+            print(name, ": no changes since last scan of", commit)
+            xml_shas, changes = last_xml_shas, {}
+        elif last_commit and commit_exists(last_commit):
+            changes = diff_xml_blobs(last_commit, commit, start)
+            print(name, ":", len(changes), "XMLs changed since last scan of", last_commit)
+            xml_shas = dict(last_xml_shas)
+            for filename, sha in changes.items():
+                if sha:
+                    xml_shas[filename] = sha
+                else:
+                    xml_shas.pop(filename, None)
+        # Use the commit, not ref, so what we store is exactly what we looked at
+        ref = commit
+    if xml_shas is None:
+        xml_shas = dict(list_xml_blobs(ref, start))
+    blobs = sorted(xml_shas.items())
+
+    if changes is None or want_lists:
+        wanted_shas = set(xml_shas.values())
     else:
-        return dirname
+        wanted_shas = set()
+    if changes:
+        # Old versions are needed to take their ntuples out of the stored scan
+        wanted_shas.update(last_xml_shas[f] for f in changes if f in last_xml_shas)
+        wanted_shas.update(sha for sha in changes.values() if sha)
+    root_files = blob_cache.get_many(wanted_shas) if blob_cache else {}
+    new_shas = sorted(wanted_shas - set(root_files))
+    for sha, contents in iter_blob_contents(new_shas):
+        root_files[sha] = [e.path for e in iter_entries(contents.splitlines())
+                           if e.path.startswith(("/nfs", "/pnfs"))]
+        if blob_cache:
+            blob_cache.put(sha, root_files[sha])
+    if blob_cache:
+        blob_cache.commit()
+        if name and changes is None:
+            blob_cache.set_scan(name, start, ref, xml_shas, root_files)
+        elif name and changes:
+            removed = [(f, root_files[last_xml_shas[f]]) for f in sorted(changes) if f in last_xml_shas]
+            added = [(f, sha, root_files[sha]) for f, sha in sorted(changes.items()) if sha]
+            blob_cache.update_scan(name, ref, removed, added)
+    print(ref, start, ":", len(blobs), "XMLs,", len(new_shas), "new blobs parsed")
+    if changes is not None and not want_lists:
+        return [filename for filename, _ in blobs], None
+    return [filename for filename, _ in blobs], [root_files[sha] for _, sha in blobs]
 
 
 def save_list_to_file(this_list, output_filename):
@@ -124,8 +412,158 @@ def save_list_to_file(this_list, output_filename):
         f.write("\n".join(this_list))
 
 
-def do_legacy_branches(check_missing):
-    """Handle the UHH2/common/datasets directories for legacy branches"""
+def get_ntuple_dirs(root_files):
+    """Get set of ntuple directories used by a list of ntuples, without the CRAB job subdirectories"""
+    # most ntuples in an XML share a directory, so only remove_crab_dir once per directory
+    return set([remove_crab_dir(d) for d in set([os.path.dirname(r) for r in root_files])])
+
+
+def make_dir_map(root_files_lists):
+    """Make map of ntuple directory -> indices of XMLs that use it, in one pass.
+
+    Parameters
+    ----------
+    root_files_lists : list[list[str]]
+        List of ntuple filenames for each XML
+
+    Returns
+    -------
+    dict[str, list[int]]
+        Indices of the XMLs (in root_files_lists) using each directory, in ascending order
+    """
+    dir_map = {}
+    for ind, rfl in enumerate(root_files_lists):
+        for rd in get_ntuple_dirs(rfl):
+            dir_map.setdefault(rd, []).append(ind)
+    return dir_map
+
+
+def save_outputs(name, all_root_files, dir_xmls, output_dir):
+    """Write lists of ntuple filenames & directories, and map of directory -> XMLs.
+
+    Parameters
+    ----------
+    name : str
+        Branch or release name, used in output filenames
+    all_root_files : list[str]
+        Sorted list of unique ntuples
+    dir_xmls : iterable[(str, list[str])]
+        (ntuple directory, XMLs using it), sorted by directory
+    output_dir : str
+        Directory to write output files to
+    """
+    file_log_filename = "ntuple_filenames_"+name+".txt"
+    save_list_to_file(all_root_files, os.path.join(output_dir, file_log_filename))
+    print("Found", len(all_root_files), "ntuples, list saved to", file_log_filename)
+
+    all_root_files_dirs = []
+    with open(os.path.join(output_dir, "%s_dir_map.txt" % name), "w") as f:
+        for rd, xmls in dir_xmls:
+            all_root_files_dirs.append(rd)
+            f.write(rd + "::\n")
+            for xf in xmls:
+                f.write("\t" + xf.lstrip("common/datasets/") + "\n")
+
+    dir_log_filename = "ntuple_dirnames_"+name+".txt"
+    save_list_to_file(all_root_files_dirs, os.path.join(output_dir, dir_log_filename))
+    print("Found", len(all_root_files_dirs), "ntuple dirs, list saved to", dir_log_filename)
+
+
+def process_xml_files(name, xml_files, check_missing, stat_engine, output_dir="..", root_files_lists=None):
+    """Find ntuples used by XML files in one branch/release, and save info about them.
+
+    Writes lists of ntuple filenames & directories, a map of directory -> XMLs,
+    and optionally list of missing files.
+
+    Parameters
+    ----------
+    name : str
+        Branch or release name, used in output filenames
+    xml_files : list[str]
+        XML files to look at
+    check_missing : bool
+        If True, check which ntuples no longer exist
+    stat_engine : ntupleStat.StatEngine
+        To check ntuples exist
+    output_dir : str, optional
+        Directory to write output files to. Default is the parent directory,
+        since we are inside the repo clone.
+    root_files_lists : list[list[str]], optional
+        Ntuples in each XML, if already known. Otherwise XML files are read from disk.
+
+    Returns
+    -------
+    list[str], list[list[str]], dict[str, ntupleStat.StatResult]
+        XML files, list of ntuples in each, and stat result for each ntuple
+        (empty if check_missing is False)
+    """
+    these_root_files_lists = root_files_lists
+    if these_root_files_lists is None:
+        these_root_files_lists = [get_root_files_from_xml(x) for x in xml_files]
+    all_root_files = []
+    for l in these_root_files_lists:
+        all_root_files.extend(l)
+
+    # Write missing files to file
+    stat_results = {}
+    if check_missing:
+        print("Doing missing files")
+        # Ntuples can appear in many XMLs, so only stat each once
+        unique_root_files = sorted(set(all_root_files))
+        for rf, stat_result in stat_engine.imap(unique_root_files):
+            stat_results[rf] = stat_result
+        missing_counter = 0
+        with open(os.path.join(output_dir, "%s_missing.txt" % name), "w") as f:
+            for xf, these_root_files in zip(xml_files, these_root_files_lists):
+                first_time = True
+                for rf in these_root_files:
+                    if not stat_results[rf].exists:
+                        missing_counter += 1
+                        if first_time:
+                            f.write(xf + "::\n")
+                            first_time = False
+                        f.write(rf + "\n")
+        print("# Missing files:", missing_counter)
+
+    print("Doing dir map")
+    dir_map = make_dir_map(these_root_files_lists)
+    dir_xmls = [(rd, [xml_files[ind] for ind in dir_map[rd]]) for rd in sorted(dir_map)]
+    save_outputs(name, sorted(set(all_root_files)), dir_xmls, output_dir)
+
+    return xml_files, these_root_files_lists, stat_results
+
+
+def fill_catalogue(catalogue, name, xml_files, root_files_lists, stat_results, xml_top="."):
+    """Store XMLs & ntuples for one branch/release in the catalogue.
+
+    Parameters
+    ----------
+    catalogue : ntupleCatalogue.NtupleCatalogue
+    name : str
+        Branch or release name
+    xml_files, root_files_lists, stat_results
+        As returned by process_xml_files()
+    xml_top : str, optional
+        Directory that XML paths in the catalogue are relative to
+    """
+    xml_paths = [os.path.relpath(xf, xml_top) for xf in xml_files]
+    for xml_path, rfl in zip(xml_paths, root_files_lists):
+        catalogue.add_xml(name, xml_path, get_year_from_dir(xml_path),
+                          [(rf, stat_results.get(rf)) for rf in rfl])
+    catalogue.prune(name, xml_paths)
+    print("Catalogue updated for", name, ":", catalogue.filename)
+
+
+def setup_legacy_repo():
+    """Setup UHH2 clone & figure out which legacy branches to look at.
+
+    Leaves you inside the clone directory.
+
+    Returns
+    -------
+    list[str]
+        Branch names
+    """
     # Setup UHH2 in clean directory avoid any contamination
     deploy_dirname = "UHHCounting"
     if not os.path.isdir(deploy_dirname):
@@ -139,149 +577,217 @@ def do_legacy_branches(check_missing):
     our_list_of_branches = [REMOTE_NAME+"/"+x for x in LEGACY_BRANCHES]
 
     list_of_remote_branches = get_all_remote_branches()
-    list_of_local_branches = get_all_local_branches()
 
     important_branches = sorted(list(set(our_list_of_branches) & set(list_of_remote_branches)))
     print("Only looking in branches:", important_branches)
+    return [b.lstrip(REMOTE_NAME+"/") for b in important_branches]
 
-    for remote_branch in important_branches[:]:
-        all_root_files = []
-        remote_branch = remote_branch.lstrip(REMOTE_NAME+"/")
-        local_branch_name = remote_branch
-        checkout_branch(remote_branch, local_branch_name)
-        pull_branch()
-        xml_files = find_xml_files()
-        these_root_files_lists = [get_root_files_from_xml(x) for x in xml_files]
-        for l in these_root_files_lists:
-            all_root_files.extend(l)
 
-        # Write missing files to file
-        if check_missing:
-            print("Doing missing files")
-            missing_counter = 0
-            with open("../%s_missing.txt" % remote_branch, "w") as f:
-                for xf in xml_files:
-                    first_time = True
-                    these_root_files = get_root_files_from_xml(xf)
-                    for rf in these_root_files:
-                        if not os.path.isfile(rf):
-                            missing_counter += 1
-                            if first_time:
-                                f.write(xf + "::\n")
-                                first_time = False
-                            f.write(rf + "\n")
-            print("# Missing files:", missing_counter)
-
-        # Write list of all filenames
-        all_root_files = sorted(list(set(all_root_files)))
-        file_log_filename = "ntuple_filenames_"+remote_branch+".txt"
-        # use .. as we're in the UHH repo
-        save_list_to_file(all_root_files, "../"+file_log_filename)
-        print("Found", len(all_root_files), "ntuples, list saved to", file_log_filename)
-
-        # Write list of all directory names
-        all_root_files_dirs = sorted(list(set([remove_crab_dir(os.path.dirname(f))
-                                               for f in all_root_files])))
-        dir_log_filename = "ntuple_dirnames_"+remote_branch+".txt"
-        # use .. as we're in the UHH repo
-        save_list_to_file(all_root_files_dirs, "../"+dir_log_filename)
-        print("Found", len(all_root_files_dirs), "ntuple dirs, list saved to", dir_log_filename)
-
-        # Write map of dirname -> XMLs
-        print("Doing dir map")
-        these_root_dirs_lists = [sorted(list(set([remove_crab_dir(os.path.dirname(r))
-                                                  for r in rfl])))
-                                 for rfl in these_root_files_lists]
-        with open("../%s_dir_map.txt" % remote_branch, "w") as f:
-            for rd in all_root_files_dirs:
-                f.write(rd + "::\n")
-                for ind, rdl in enumerate(these_root_dirs_lists):
-                    if rd in rdl:
-                        f.write("\t" + xml_files[ind].lstrip("common/datasets/") + "\n")
-    os.chdir("..")
+def setup_datasets_repo(git_objects=False):
+    """Setup up-to-date UHH2-datasets clone & figure out which releases it has.
 
+    Leaves you inside the clone directory.
 
-def do_new_branches(check_missing):
-    """Handle the 102X and 106X branches: these use UHH2-datasets repo"""
+    Parameters
+    ----------
+    git_objects : bool, optional
+        If True, only fetch, and look at the releases in DATASETS_REF,
+        rather than checking out master.
+
+    Returns
+    -------
+    list[str]
+        Release names, each is a directory in the repo
+    """
     # Clone UHH2-datasets repo if necessary
     datasets_dirname = 'UHH2-datasets'
     if not os.path.isdir(datasets_dirname):
         print("Cloning repo since I can't find an existing clone under", datasets_dirname)
-        clone_repo = True
         init_repo('https://github.com/UHH2/UHH2-datasets', datasets_dirname)
     else:
         os.chdir(datasets_dirname)
-    checkout_branch('master', 'master')
-    pull_branch()
 
     # Instead of iterating through branches, we iterate through directories,
     # each of which corresponds to a release
-    releases = [x for x in os.listdir('.') if os.path.isdir(x) and 'RunII' in x]
+    if git_objects:
+        subprocess.check_call(["git", "fetch", REMOTE_NAME])
+        out = subprocess.check_output(["git", "ls-tree", "-d", "--name-only", DATASETS_REF])
+        releases = [x for x in out.decode().splitlines() if 'RunII' in x]
+    else:
+        checkout_branch('master', 'master')
+        pull_branch()
+        releases = [x for x in os.listdir('.') if os.path.isdir(x) and 'RunII' in x]
     print('Considering', releases, 'in UHH2-datasets')
-    for release in releases:
+    return releases
+
+
+def do_legacy_branches(check_missing, stat_engine, catalogue=None):
+    """Handle the UHH2/common/datasets directories for legacy branches"""
+    for remote_branch in setup_legacy_repo():
+        local_branch_name = remote_branch
+        checkout_branch(remote_branch, local_branch_name)
+        pull_branch()
+        xml_files = find_xml_files()
+        results = process_xml_files(remote_branch, xml_files, check_missing, stat_engine)
+        if catalogue:
+            fill_catalogue(catalogue, remote_branch, *results, xml_top='common/datasets')
+    os.chdir("..")
+
+
+def do_new_branches(check_missing, stat_engine, catalogue=None):
+    """Handle the 102X and 106X branches: these use UHH2-datasets repo"""
+    for release in setup_datasets_repo():
         # Do usual finding of XML files, check missing, save to txt files
         xml_files = find_xml_files(start=release)
-        these_root_files_lists = [get_root_files_from_xml(x) for x in xml_files]
-        all_root_files = []
-        for l in these_root_files_lists:
-            all_root_files.extend(l)
+        results = process_xml_files(release, xml_files, check_missing, stat_engine)
+        if catalogue:
+            fill_catalogue(catalogue, release, *results)
+
+    os.chdir("..")
 
-        # Write missing files to file
-        if check_missing:
-            print("Doing missing files")
-            missing_counter = 0
-            # use .. as we're in the UHH repo
-            with open("../%s_missing.txt" % release, "w") as f:
-                for xf in xml_files:
-                    first_time = True
-                    these_root_files = get_root_files_from_xml(xf)
-                    for rf in these_root_files:
-                        if not os.path.isfile(rf):
-                            missing_counter += 1
-                            if first_time:
-                                f.write(xf + "::\n")
-                                first_time = False
-                            f.write(rf + "\n")
-            print("# Missing files:", missing_counter)
-
-        # Write list of all filenames
-        all_root_files = sorted(list(set(all_root_files)))
-        file_log_filename = "ntuple_filenames_"+release+".txt"
-        # use .. as we're in the UHH repo
-        save_list_to_file(all_root_files, "../"+file_log_filename)
-        print("Found", len(all_root_files), "ntuples, list saved to", file_log_filename)
-
-        # Write list of all directory names
-        all_root_files_dirs = sorted(list(set([remove_crab_dir(os.path.dirname(f))
-                                               for f in all_root_files])))
-        dir_log_filename = "ntuple_dirnames_"+release+".txt"
-        # use .. as we're in the UHH repo
-        save_list_to_file(all_root_files_dirs, "../"+dir_log_filename)
-        print("Found", len(all_root_files_dirs), "ntuple dirs, list saved to", dir_log_filename)
-
-        # Write map of dirname -> XMLs
-        print("Doing dir map")
-        these_root_dirs_lists = [sorted(list(set([remove_crab_dir(os.path.dirname(r))
-                                                  for r in rfl])))
-                                 for rfl in these_root_files_lists]
-        with open("../%s_dir_map.txt" % release, "w") as f:
-            for rd in all_root_files_dirs:
-                f.write(rd + "::\n")
-                for ind, rdl in enumerate(these_root_dirs_lists):
-                    if rd in rdl:
-                        f.write("\t" + xml_files[ind].lstrip("common/datasets/") + "\n")
 
+# To describe the scanning of one branch/release in its own process:
+# work_dir is the (absolute) directory to work in, xml_start where to look for XMLs,
+# xml_top what XML paths in the catalogue are relative to, and ref the git ref
+# to read XMLs from (or None to read the files in work_dir)
+ScanJob = namedtuple('ScanJob', 'name work_dir xml_start xml_top ref')
+
+
+def setup_worktree(ref, worktree_dir):
+    """Check out ref in its own git worktree of the current repo, detached from any branch.
+
+    Re-uses the worktree if it already exists.
+    """
+    subprocess.check_call(["git", "worktree", "prune"])
+    if os.path.isdir(worktree_dir):
+        subprocess.check_call(["git", "checkout", "-q", "--force", "--detach", ref], cwd=worktree_dir)
+    else:
+        subprocess.check_call(["git", "worktree", "add", "-q", "--detach", worktree_dir, ref])
+
+
+def get_legacy_scan_jobs(git_objects=False):
+    """Fetch legacy branches, and make a job to scan each.
+
+    If git_objects, XMLs are read from git objects, otherwise each branch is
+    checked out in its own worktree, so they can be scanned in parallel
+    """
+    branches = setup_legacy_repo()
+    subprocess.check_call(["git", "fetch", REMOTE_NAME])
+    worktree_top = os.path.abspath(os.path.join("..", "UHHCounting-worktrees"))
+    jobs = []
+    for branch in branches:
+        if git_objects:
+            jobs.append(ScanJob(branch, os.getcwd(), 'common/datasets', 'common/datasets',
+                                REMOTE_NAME + "/" + branch))
+            continue
+        worktree_dir = os.path.join(worktree_top, branch)
+        print("Checking out", branch, "to", worktree_dir)
+        setup_worktree(REMOTE_NAME + "/" + branch, worktree_dir)
+        jobs.append(ScanJob(branch, worktree_dir, 'common/datasets', 'common/datasets', None))
     os.chdir("..")
+    return jobs
 
 
-def main(check_missing=True):
+def get_new_scan_jobs(git_objects=False):
+    """Update UHH2-datasets, one job per release. These can all share the same checkout."""
+    releases = setup_datasets_repo(git_objects)
+    ref = DATASETS_REF if git_objects else None
+    jobs = [ScanJob(release, os.getcwd(), release, ".", ref) for release in releases]
+    os.chdir("..")
+    return jobs
+
+
+def _run_scan_job(job_options):
+    """Scan one branch/release. Can be run in a separate process, since it changes directory."""
+    job, options = job_options
+    os.chdir(job.work_dir)
+    stat_cache = StatCache(*options['stat_cache_args']) if options['stat_cache_args'] else None
+    with StatEngine(num_workers=options['num_workers'], max_rate=options['max_stat_rate'],
+                    cache=stat_cache) as stat_engine:
+        results = None
+        if job.ref:
+            blob_cache = BlobCache(options['blob_cache']) if options['blob_cache'] else None
+            # Missing files & the catalogue need the ntuples in every XML,
+            # otherwise an incremental run can make the outputs from the stored scan
+            want_lists = options['check_missing'] or options['want_results']
+            xml_files, root_files_lists = get_root_files_from_git(job.ref, job.xml_start, blob_cache,
+                                                                  name=job.name if options['incremental'] else None,
+                                                                  want_lists=want_lists)
+            if root_files_lists is None:
+                print("Writing outputs for", job.name, "from stored scan")
+                save_outputs(job.name, blob_cache.get_scan_ntuples(job.name),
+                             blob_cache.iter_scan_dir_map(job.name), options['output_dir'])
+            if blob_cache:
+                blob_cache.close()
+        else:
+            xml_files, root_files_lists = find_xml_files(job.xml_start), None
+        if root_files_lists is not None or not job.ref:
+            results = process_xml_files(job.name, xml_files, options['check_missing'], stat_engine,
+                                        output_dir=options['output_dir'], root_files_lists=root_files_lists)
+    if stat_cache:
+        stat_cache.close()
+    # Avoid sending the results back if not needed, since they can be large
+    return job, (results if options['want_results'] else None)
+
+
+def do_scan_jobs(check_missing, stat_cache, catalogue, num_workers, max_stat_rate, num_jobs,
+                 git_objects=False, blob_cache=None, incremental=False):
+    """Handle legacy branches & UHH2-datasets releases as separate jobs.
+
+    With num_jobs > 1, these are run in parallel in a pool of processes.
+    """
+    output_dir = os.getcwd()
+    scan_jobs = get_legacy_scan_jobs(git_objects) + get_new_scan_jobs(git_objects)
+    options = {
+        'check_missing': check_missing,
+        'output_dir': output_dir,
+        'num_workers': num_workers,
+        # The rate limit is for all processes combined
+        'max_stat_rate': max_stat_rate / float(num_jobs) if max_stat_rate else None,
+        'stat_cache_args': ((os.path.abspath(stat_cache.filename), stat_cache.ttl, stat_cache.refresh)
+                            if stat_cache else None),
+        'blob_cache': os.path.abspath(blob_cache) if blob_cache else None,
+        'incremental': incremental,
+        'want_results': catalogue is not None,
+    }
+    job_args = [(j, options) for j in scan_jobs]
+    pool = multiprocessing.Pool(num_jobs) if num_jobs > 1 else None
+    try:
+        all_results = pool.imap_unordered(_run_scan_job, job_args) if pool else (_run_scan_job(x) for x in job_args)
+        for job, results in all_results:
+            os.chdir(output_dir)
+            print("Finished", job.name)
+            if catalogue:
+                fill_catalogue(catalogue, job.name, *results, xml_top=job.xml_top)
+    finally:
+        os.chdir(output_dir)
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def main(check_missing=True, stat_cache=None, catalogue=None, num_workers=16, max_stat_rate=1000, num_jobs=1,
+         git_objects=False, blob_cache=None, incremental=False):
     t2_example_dir = '/pnfs/desy.de/cms/tier2/'
     if check_missing and not os.path.isdir(t2_example_dir):
         print("Cannot find", t2_example_dir, " - skipping missing file check")
         check_missing = False
 
-    do_legacy_branches(check_missing)
-    do_new_branches(check_missing)
+    if incremental:
+        if not blob_cache:
+            raise ValueError("Incremental runs need a blob cache to store the last commit scanned")
+        git_objects = True
+
+    if num_jobs > 1 or git_objects:
+        do_scan_jobs(check_missing, stat_cache, catalogue, num_workers, max_stat_rate, num_jobs,
+                     git_objects=git_objects, blob_cache=blob_cache, incremental=incremental)
+        return 0
+
+    with StatEngine(num_workers=num_workers, max_rate=max_stat_rate, cache=stat_cache) as stat_engine:
+        do_legacy_branches(check_missing, stat_engine, catalogue)
+        do_new_branches(check_missing, stat_engine, catalogue)
+        if check_missing:
+            stat_engine.print_report()
 
     return 0
 
@@ -291,5 +797,41 @@ if __name__ == "__main__":
     parser.add_argument('--checkMissing',
                         help='Compile lists of ntuples in XMLs that no longer exist on disk (slow)',
                         action='store_true')
+    parser.add_argument('--numWorkers',
+                        default=16, type=int,
+                        help='Number of ntuples to stat concurrently when checking missing files')
+    parser.add_argument('--maxStatRate',
+                        default=1000, type=float,
+                        help='Maximum number of ntuples to stat per second, '
+                        'to avoid stressing the filesystem. 0 for no limit.')
+    parser.add_argument('-j', '--jobs',
+                        default=1, type=int,
+                        help='Number of branches/releases to scan in parallel, each in its own process. '
+                        'Legacy branches are checked out into separate git worktrees under UHHCounting-worktrees.')
+    parser.add_argument('--gitObjects',
+                        help='Read XMLs straight from git objects rather than checking out each branch. '
+                        'Does not touch the working trees.',
+                        action='store_true')
+    parser.add_argument('--blobCache',
+                        default='findAllNtupleDirs_blobs.sqlite',
+                        help='With --gitObjects, SQLite file to store ntuples found in each XML blob, '
+                        'so XMLs unchanged since an earlier run are not read again. Set to "" to disable.')
+    parser.add_argument('--incremental',
+                        help='Only re-read XMLs that changed (according to git diff) since the commit '
+                        'last scanned for each branch/release, as stored in --blobCache. Implies --gitObjects.',
+                        action='store_true')
+    add_stat_cache_args(parser)
+    parser.add_argument('--catalogue',
+                        help='Also add results to this SQLite ntuple catalogue, see ntupleCatalogue.py')
     args = parser.parse_args()
-    sys.exit(main(check_missing=args.checkMissing))
+    stat_cache = stat_cache_from_args(args)
+    # abspath since we change directory later
+    catalogue = NtupleCatalogue(os.path.abspath(args.catalogue)) if args.catalogue else None
+    status = main(check_missing=args.checkMissing, stat_cache=stat_cache, catalogue=catalogue,
+                  num_workers=args.numWorkers, max_stat_rate=args.maxStatRate, num_jobs=args.jobs,
+                  git_objects=args.gitObjects, blob_cache=args.blobCache, incremental=args.incremental)
+    if stat_cache:
+        stat_cache.close()
+    if catalogue:
+        catalogue.close()
+    sys.exit(status)
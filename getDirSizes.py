@@ -5,29 +5,132 @@
 This script takes a file with list of directories, and produces a file with
 each directory name and its size in kBytes.
 
-If the directory does not exist, it has size 0
+If the directory does not exist, it has size 0.
+
+Directories are walked concurrently, and written out as they finish,
+so the output order may differ from the input order.
 """
 
 
 from __future__ import print_function
 import os
+import stat
 import argparse
-import subprocess
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2: use the scandir backport if available, else listdir + lstat
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from ntupleStat import add_stat_cache_args, stat_cache_from_args
+
+
+def _iter_dir(dirname):
+    """Yield (path, lstat result, is directory) for each entry in dirname"""
+    if scandir:
+        for entry in scandir(dirname):
+            st = entry.stat(follow_symlinks=False)
+            yield entry.path, st, stat.S_ISDIR(st.st_mode)
+    else:
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            st = os.lstat(path)
+            yield path, st, stat.S_ISDIR(st.st_mode)
+
+
+def _disk_usage(st):
+    """Disk usage of a file in bytes, like du: allocated blocks if known, else size"""
+    blocks = getattr(st, 'st_blocks', None)
+    return blocks * 512 if blocks is not None else st.st_size
+
+
+def get_dir_size(dirname, max_depth=None):
+    """Get size of directory in kB, like du -s, but without a subprocess.
 
-if not hasattr(subprocess, 'check_output'):
-    raise ImportError("subprocess module missing check_output(): you need python 2.7 or newer")
+    Doesn't follow symlinks, and counts hard-linked files once.
 
+    Parameters
+    ----------
+    dirname : str
+    max_depth : int, optional
+        Don't go into subdirectories more than this many levels below dirname,
+        e.g. 1 for <dirname>/0000/Ntuple_1.root.
+        None for no limit.
 
-def get_dir_size(dirname):
-    """Get size of directory using du, returned in kB"""
-    cmd = 'du -s %s' % dirname
-    size = int(subprocess.check_output(cmd, shell=True).split()[0])
-    return size
+    Returns
+    -------
+    int
+    """
+    total = _disk_usage(os.lstat(dirname))
+    seen_inodes = set()
+    to_walk = [(dirname, 0)]
+    while to_walk:
+        this_dir, depth = to_walk.pop()
+        try:
+            entries = list(_iter_dir(this_dir))
+        except OSError as e:
+            print("Cannot read", this_dir, ":", e)
+            continue
+        for path, st, is_dir in entries:
+            if st.st_nlink > 1 and not is_dir:
+                if (st.st_dev, st.st_ino) in seen_inodes:
+                    continue
+                seen_inodes.add((st.st_dev, st.st_ino))
+            total += _disk_usage(st)
+            if is_dir and (max_depth is None or depth < max_depth):
+                to_walk.append((path, depth + 1))
+    return (total + 1023) // 1024
+
+
+def iter_dir_sizes(dirnames, num_workers=8, max_depth=None, stat_cache=None):
+    """Yield (dirname, size in kB) for each directory, in order of completion.
+
+    Parameters
+    ----------
+    dirnames : iterable[str]
+    num_workers : int, optional
+        Number of directories to walk at once
+    max_depth : int, optional
+        See get_dir_size()
+    stat_cache : StatCache, optional
+        If set, use cached sizes where possible, and store new ones
+    """
+    def size_func(dirname):
+        return get_dir_size(dirname, max_depth=max_depth)
+
+    def worker(dirname):
+        if not os.path.isdir(dirname):
+            return dirname, 0
+        if stat_cache:
+            return dirname, stat_cache.get_dir_size(dirname, size_func, max_depth=max_depth)
+        return dirname, size_func(dirname)
+
+    pool = ThreadPool(max(1, num_workers))
+    try:
+        for result in pool.imap_unordered(worker, dirnames):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('input', help='File with list of directories, one per line')
+    parser.add_argument('--numWorkers',
+                        help='Number of directories to walk at once',
+                        default=8, type=int)
+    parser.add_argument('--maxDepth',
+                        help='Only go this many levels of subdirectories down, '
+                        'e.g. 1 for the CRAB 0000 dirs under each ntuple directory. '
+                        'Default is no limit.',
+                        type=int)
+    add_stat_cache_args(parser)
     args = parser.parse_args()
 
     if not os.path.isfile(args.input):
@@ -37,9 +140,17 @@ if __name__ == "__main__":
     output_filename = stem + "_sizes" + ext
     print("Writing to", output_filename)
 
-    with open(args.input) as inf, open(output_filename, 'w') as outf:
-        for line in inf:
-            size = 0
-            if os.path.isdir(line.strip()):
-                size = get_dir_size(line.strip())
-            outf.write(line.strip() + ",%d\n" % size)
+    stat_cache = stat_cache_from_args(args)
+
+    with open(args.input) as inf:
+        dirnames = [line.strip() for line in inf if line.strip()]
+
+    with open(output_filename, 'w') as outf:
+        for dirname, size in iter_dir_sizes(dirnames, num_workers=args.numWorkers,
+                                            max_depth=args.maxDepth, stat_cache=stat_cache):
+            outf.write(dirname + ",%d\n" % size)
+            outf.flush()
+
+    if stat_cache:
+        stat_cache.print_report()
+        stat_cache.close()
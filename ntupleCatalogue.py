@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+
+"""Catalogue of ntuples used in XML files, stored in a SQLite database.
+
+Filled by datasetInfo.py and findAllNtupleDirs.py (with --catalogue), and can
+be queried from the command line, e.g.:
+
+    ./ntupleCatalogue.py ntuples.sqlite xmls /pnfs/desy.de/cms/tier2/store/user/robin/RunII_102X_v2/QCD
+    ./ntupleCatalogue.py ntuples.sqlite sizes [--branch RunII_102X_v2]
+    ./ntupleCatalogue.py ntuples.sqlite missing RunII_102X_v2
+"""
+
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS branches (
+    id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS years (
+    id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS directories (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS xml_files (
+    id INTEGER PRIMARY KEY,
+    branch_id INTEGER NOT NULL REFERENCES branches(id),
+    path TEXT NOT NULL,
+    year_id INTEGER REFERENCES years(id),
+    updated REAL,
+    UNIQUE (branch_id, path));
+CREATE TABLE IF NOT EXISTS ntuples (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    directory_id INTEGER NOT NULL REFERENCES directories(id),
+    user_id INTEGER REFERENCES users(id),
+    size INTEGER,
+    exists_ INTEGER,
+    checked REAL);
+CREATE TABLE IF NOT EXISTS xml_ntuples (
+    xml_id INTEGER NOT NULL REFERENCES xml_files(id),
+    ntuple_id INTEGER NOT NULL REFERENCES ntuples(id),
+    PRIMARY KEY (xml_id, ntuple_id));
+CREATE INDEX IF NOT EXISTS xml_ntuples_ntuple ON xml_ntuples (ntuple_id);
+CREATE INDEX IF NOT EXISTS ntuples_directory ON ntuples (directory_id);
+CREATE INDEX IF NOT EXISTS ntuples_user ON ntuples (user_id);
+CREATE INDEX IF NOT EXISTS ntuples_exists ON ntuples (exists_);
+CREATE INDEX IF NOT EXISTS xml_files_year ON xml_files (year_id);
+"""
+
+
+def get_user_from_filename(ntuple_filename):
+    """Get username from full filepath
+
+    Assumes it comes after .../user/
+    e.g. :
+    get_user_from_filename("/nfs/dust/cms/user/robin/UHH2/Ntuple_2016v2.root")
+    >> robin
+
+    Parameters
+    ----------
+    ntuple_filename : str
+
+    Returns
+    -------
+    str
+        Username, or None if not found
+    """
+    if "/user/" not in ntuple_filename:
+        return None
+    ntuple_filename = ntuple_filename.replace("//", "/")
+    parts = ntuple_filename.split("/")
+    ind = parts.index("user")
+    if ind == len(parts)-1:
+        return None
+    return parts[ind+1]
+
+
+def get_year_from_dir(dirname):
+    """Get dataset year from XML filepath.
+
+    Assumes it comes after RunII_*, or is the first part
+    e.g.
+    get_year_from_dir("../common/dataset/RunII_102X_v1/2017v2/MC_TTbar.xml")
+    >> "2017v2"
+
+    Parameters
+    ----------
+    dirname : str
+
+    Returns
+    -------
+    str
+        Year, or None if not found
+    """
+    parts = dirname.split("/")
+    branch = "RunII_"
+    for p in parts:
+        if branch in p:
+            ind = parts.index(p)
+            if ind == len(parts)-1:
+                return None
+            return parts[ind+1]
+    else:
+        return parts[0]
+
+
+def get_branch_from_dir(dirname, default=None):
+    """Get branch/release name (the first RunII_* part) from XML filepath, or default if none"""
+    for p in dirname.split("/"):
+        if "RunII_" in p:
+            return p
+    return default
+
+
+def remove_crab_dir(dirname):
+    """If dir path ends with e.g. 0001 added by crab, remove it"""
+    dirname = dirname.rstrip("/")  # a trailing / will screw up basename
+    last_dir = os.path.basename(dirname)
+    if re.match(r'^\d\d\d\d$', last_dir):
+        return os.path.dirname(dirname)
+    else:
+        return dirname
+
+
+class NtupleCatalogue(object):
+    """Interface to the SQLite catalogue of branches, XMLs & ntuples.
+
+    Parameters
+    ----------
+    filename : str
+        SQLite file, created if it doesn't exist
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename)
+        self._conn.executescript(SCHEMA)
+        # Small lookup tables are kept in memory to save queries
+        self._id_cache = {table: {} for table in ("branches", "users", "years", "directories")}
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def commit(self):
+        self._conn.commit()
+
+    def _get_id(self, table, value, column="name"):
+        """Get id of row with column == value in table, creating it if necessary"""
+        if value is None:
+            return None
+        cache = self._id_cache[table]
+        if value not in cache:
+            self._conn.execute("INSERT OR IGNORE INTO %s (%s) VALUES (?)" % (table, column), (value,))
+            cache[value] = self._conn.execute("SELECT id FROM %s WHERE %s = ?" % (table, column),
+                                              (value,)).fetchone()[0]
+        return cache[value]
+
+    def add_xml(self, branch, xml_path, year, ntuples):
+        """Add or update an XML file and the ntuples it uses.
+
+        Any ntuples previously associated with the XML are replaced.
+
+        Parameters
+        ----------
+        branch : str
+            Branch or release name, e.g. RunII_102X_v2
+        xml_path : str
+            Path of XML file relative to top of datasets directory
+        year : str
+            Dataset year, e.g. 2017v2
+        ntuples : list[(str, ntupleStat.StatResult or None)]
+            Ntuple filepaths, each with its stat result if known
+        """
+        now = time.time()
+        branch_id = self._get_id("branches", branch)
+        year_id = self._get_id("years", year)
+        cur = self._conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO xml_files (branch_id, path) VALUES (?, ?)", (branch_id, xml_path))
+        xml_id = cur.execute("SELECT id FROM xml_files WHERE branch_id = ? AND path = ?",
+                             (branch_id, xml_path)).fetchone()[0]
+        cur.execute("UPDATE xml_files SET year_id = ?, updated = ? WHERE id = ?", (year_id, now, xml_id))
+        cur.execute("DELETE FROM xml_ntuples WHERE xml_id = ?", (xml_id,))
+
+        ntuple_ids = set()
+        for ntuple_path, stat_result in ntuples:
+            directory_id = self._get_id("directories", remove_crab_dir(os.path.dirname(ntuple_path)), column="path")
+            user_id = self._get_id("users", get_user_from_filename(ntuple_path))
+            cur.execute("INSERT OR IGNORE INTO ntuples (path, directory_id, user_id) VALUES (?, ?, ?)",
+                        (ntuple_path, directory_id, user_id))
+            if stat_result is not None:
+                cur.execute("UPDATE ntuples SET size = ?, exists_ = ?, checked = ? WHERE path = ?",
+                            (stat_result.size, int(stat_result.exists), now, ntuple_path))
+            ntuple_ids.add(cur.execute("SELECT id FROM ntuples WHERE path = ?", (ntuple_path,)).fetchone()[0])
+        cur.executemany("INSERT INTO xml_ntuples VALUES (?, ?)", [(xml_id, n) for n in ntuple_ids])
+
+    def prune(self, branch, xml_paths):
+        """Remove XMLs in branch that aren't in xml_paths, and any ntuples no longer used by any XML"""
+        branch_id = self._get_id("branches", branch)
+        xml_paths = set(xml_paths)
+        old_xmls = [(xml_id, path) for xml_id, path
+                    in self._conn.execute("SELECT id, path FROM xml_files WHERE branch_id = ?", (branch_id,))
+                    if path not in xml_paths]
+        for xml_id, path in old_xmls:
+            self._conn.execute("DELETE FROM xml_ntuples WHERE xml_id = ?", (xml_id,))
+            self._conn.execute("DELETE FROM xml_files WHERE id = ?", (xml_id,))
+        self._conn.execute("DELETE FROM ntuples WHERE id NOT IN (SELECT ntuple_id FROM xml_ntuples)")
+        self._conn.commit()
+        return len(old_xmls)
+
+    def xmls_for_directory(self, dirname):
+        """Get list of (branch, XML path) that use ntuples in directory"""
+        return self._conn.execute(
+            "SELECT DISTINCT b.name, x.path FROM directories d "
+            "JOIN ntuples n ON n.directory_id = d.id "
+            "JOIN xml_ntuples xn ON xn.ntuple_id = n.id "
+            "JOIN xml_files x ON x.id = xn.xml_id "
+            "JOIN branches b ON b.id = x.branch_id "
+            "WHERE d.path = ? ORDER BY b.name, x.path",
+            (remove_crab_dir(dirname),)).fetchall()
+
+    def sizes_per_user_year(self, branch=None):
+        """Get list of (user, year, number of ntuples, total size in bytes).
+
+        Each ntuple is only counted once per user & year, even if it is used
+        in several XMLs. Ntuples with unknown size count as 0.
+        """
+        where, params = "", ()
+        if branch:
+            where, params = "JOIN branches b ON b.id = x.branch_id WHERE b.name = ?", (branch,)
+        return self._conn.execute(
+            "SELECT u.name, y.name, COUNT(*), COALESCE(SUM(n.size), 0) FROM "
+            "(SELECT DISTINCT xn.ntuple_id AS ntuple_id, x.year_id AS year_id FROM xml_ntuples xn "
+            "JOIN xml_files x ON x.id = xn.xml_id " + where + ") t "
+            "JOIN ntuples n ON n.id = t.ntuple_id "
+            "LEFT JOIN users u ON u.id = n.user_id "
+            "LEFT JOIN years y ON y.id = t.year_id "
+            "GROUP BY u.name, y.name ORDER BY u.name, y.name",
+            params).fetchall()
+
+    def missing_files(self, branch):
+        """Get list of (XML path, ntuple path) for ntuples in branch known to be missing"""
+        return self._conn.execute(
+            "SELECT x.path, n.path FROM branches b "
+            "JOIN xml_files x ON x.branch_id = b.id "
+            "JOIN xml_ntuples xn ON xn.xml_id = x.id "
+            "JOIN ntuples n ON n.id = xn.ntuple_id "
+            "WHERE b.name = ? AND n.exists_ = 0 ORDER BY x.path, n.path",
+            (branch,)).fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("catalogue", help="SQLite catalogue file")
+    subparsers = parser.add_subparsers(dest="query")
+    xmls_parser = subparsers.add_parser("xmls", help="List XMLs that reference a directory")
+    xmls_parser.add_argument("directory", help="Ntuple directory (trailing CRAB 000X dirs are ignored)")
+    sizes_parser = subparsers.add_parser("sizes", help="Total size per user per year")
+    sizes_parser.add_argument("--branch", help="Only consider this branch/release")
+    missing_parser = subparsers.add_parser("missing", help="List missing ntuples in a branch/release")
+    missing_parser.add_argument("branch", help="Branch/release name")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.catalogue):
+        raise IOError("Cannot find catalogue %s" % args.catalogue)
+
+    catalogue = NtupleCatalogue(args.catalogue)
+
+    if args.query == "xmls":
+        for branch, xml_path in catalogue.xmls_for_directory(args.directory):
+            print(branch, xml_path)
+
+    elif args.query == "sizes":
+        print("%-20s %-10s %10s %12s" % ("User", "Year", "# ntuples", "Size [GB]"))
+        for user, year, num, size in catalogue.sizes_per_user_year(args.branch):
+            print("%-20s %-10s %10d %12.1f" % (user, year, num, size / (1024.0 ** 3)))
+
+    elif args.query == "missing":
+        last_xml = None
+        for xml_path, ntuple_path in catalogue.missing_files(args.branch):
+            if xml_path != last_xml:
+                print(xml_path + "::")
+                last_xml = xml_path
+            print(ntuple_path)
+
+    else:
+        parser.print_help()
+
+    catalogue.close()
+    sys.exit(0)
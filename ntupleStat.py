@@ -0,0 +1,427 @@
+"""Check existence & size of many files concurrently, without hammering the filesystem.
+
+Used by the scripts here to stat ntuples on dCache/NFS:
+
+    with StatEngine(num_workers=16, max_rate=1000) as engine:
+        for path, result in engine.imap(paths):
+            print(path, result.exists, result.size)
+        engine.print_report()
+
+Results can be kept between runs in a StatCache, so that only files in
+directories that have changed since the last run are stat-ed again:
+
+    cache = StatCache("stat_cache.sqlite", ttl=7*24*3600)
+    with StatEngine(cache=cache) as engine:
+        ...
+    cache.close()
+"""
+
+
+from __future__ import print_function
+
+import os
+import stat
+import time
+import errno
+import sqlite3
+import threading
+from bisect import bisect_left
+from collections import namedtuple, deque
+from multiprocessing.pool import ThreadPool
+
+
+# To hold info about a stat-ed file. size is in bytes, mtime in seconds since epoch.
+# For missing files (or things that aren't regular files) exists is False,
+# and size & mtime are 0
+StatResult = namedtuple('StatResult', 'path exists size mtime')
+
+
+def stat_file(path):
+    """Stat a file, return StatResult"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return StatResult(path, False, 0, 0)
+    if not stat.S_ISREG(st.st_mode):
+        return StatResult(path, False, 0, 0)
+    return StatResult(path, True, st.st_size, st.st_mtime)
+
+
+class TokenBucket(object):
+    """Thread-safe token-bucket rate limiter.
+
+    Allows bursts of up to `burst` operations, and on average `rate` per second.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst else rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, blocking until one is available"""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies, with roughly logarithmic bins in milliseconds"""
+
+    EDGES_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.EDGES_MS) + 1)
+        self.total = 0
+        self.max_ms = 0.
+
+    def add(self, seconds):
+        ms = seconds * 1000.
+        self.counts[bisect_left(self.EDGES_MS, ms)] += 1
+        self.total += 1
+        self.max_ms = max(self.max_ms, ms)
+
+    def format_lines(self, width=40):
+        """Get list of strings, one per non-empty bin, with a text bar chart"""
+        lines = []
+        max_count = max(self.counts) if self.total else 1
+        lower = 0
+        for edge, count in zip(self.EDGES_MS + [None], self.counts):
+            label = ("%g - %g ms" % (lower, edge)) if edge else ("> %g ms" % lower)
+            if count:
+                lines.append("%18s | %-*s %d" % (label, width, "#" * max(1, int(width * count / max_count)), count))
+            lower = edge
+        return lines
+
+
+class StatCache(object):
+    """On-disk cache of file stat results & directory sizes, stored in SQLite.
+
+    A cached result for a file is used if it is younger than ttl, and the
+    mtime of the file's directory hasn't changed since it was cached
+    (adding/removing files changes the directory mtime).
+    Each directory is only stat-ed once per run.
+
+    Directory sizes are keyed by the directory & the depth limit of the
+    walk that measured them, and are used if younger
+    than ttl and neither the directory nor any of its immediate
+    subdirectories (e.g. the 0000 dirs from CRAB) have a newer mtime.
+
+    Parameters
+    ----------
+    filename : str
+        SQLite file to store cache in. Prefer a local disk over NFS,
+        since SQLite file locking over NFS is unreliable.
+        Several processes can share it: it uses write-ahead logging, so reads
+        don't wait for writes, and changes are written in short transactions.
+    ttl : float, optional
+        Maximum age of cached results to use, in seconds
+    refresh : bool, optional
+        If True, ignore any cached results (but still store new ones)
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, exists_ INTEGER, size INTEGER, mtime REAL, checked REAL);
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY, mtime REAL, checked REAL);
+        -- Old caches had sizes without saying how deep the walk went, so can't be used
+        DROP TABLE IF EXISTS dir_sizes;
+        -- max_depth is -1 for no limit
+        CREATE TABLE IF NOT EXISTS dir_tree_sizes (
+            path TEXT, max_depth INTEGER, size INTEGER, mtime REAL, checked REAL,
+            PRIMARY KEY (path, max_depth));
+    """
+
+    # Write pending changes once there are this many, see flush()
+    MAX_PENDING_FILES = 1000
+    MAX_PENDING_DIRS = 100
+
+    def __init__(self, filename, ttl=7*24*3600, refresh=False):
+        self.filename = filename
+        self.ttl = ttl
+        self.refresh = refresh
+        self.now = time.time()
+        self.num_hits = 0
+        self.num_misses = 0
+        # Several processes may share the cache, so wait for each other's writes.
+        # No implicit transactions (isolation_level=None): they would hold the
+        # write lock from the first change until the next commit.
+        # get_dir_size() may be called from several threads, see _lock
+        self._conn = sqlite3.connect(filename, timeout=600, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._pending_files = []
+        self._pending_dirs = []
+        self._pending_dir_deletes = []
+        # dirname: (mtime now or None if unknown, bool whether cached entries valid)
+        self._dir_status = {}
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def flush(self):
+        """Write any pending changes to disk, in one short transaction"""
+        if not (self._pending_files or self._pending_dirs or self._pending_dir_deletes):
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Deletes first: they are queued when a directory is first checked,
+                # before any of its files are stat-ed again
+                # Use a range rather than LIKE so the primary key index is used ('0' follows '/')
+                self._conn.executemany("DELETE FROM files WHERE path >= ? AND path < ?",
+                                       [(d + "/", d + "0") for d in self._pending_dir_deletes])
+                self._conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", self._pending_dirs)
+                self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                       self._pending_files)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._pending_files = []
+            self._pending_dirs = []
+            self._pending_dir_deletes = []
+
+    def _check_dir(self, dirname):
+        """Stat directory (once per run), compare with cached mtime, store new mtime.
+
+        Returns (current mtime or None if directory missing, whether cached file entries are valid)
+        """
+        if dirname in self._dir_status:
+            return self._dir_status[dirname]
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError as e:
+            # Only a missing directory tells us anything useful
+            mtime = None if e.errno == errno.ENOENT else -1
+        row = self._conn.execute("SELECT mtime, checked FROM dirs WHERE path = ?", (dirname,)).fetchone()
+        valid = (not self.refresh and row is not None and mtime is not None and mtime >= 0
+                 and row[0] == mtime and self.now - row[1] < self.ttl)
+        if row is not None and not valid:
+            # Forget everything under this directory, since we can't trust it any more.
+            self._pending_dir_deletes.append(dirname)
+        if mtime is not None and mtime >= 0:
+            self._pending_dirs.append((dirname, mtime, row[1] if valid else self.now))
+        # Write regularly in small batches, to not block other processes using the cache
+        if len(self._pending_dirs) + len(self._pending_dir_deletes) >= self.MAX_PENDING_DIRS:
+            self.flush()
+        status = (mtime, valid)
+        self._dir_status[dirname] = status
+        return status
+
+    def get(self, path):
+        """Get cached StatResult for path, or None if it needs to be stat-ed"""
+        dir_mtime, dir_valid = self._check_dir(os.path.dirname(path))
+        if dir_mtime is None:
+            # No directory, so certainly no file
+            self.num_hits += 1
+            return StatResult(path, False, 0, 0)
+        if dir_valid:
+            row = self._conn.execute("SELECT exists_, size, mtime, checked FROM files WHERE path = ?",
+                                     (path,)).fetchone()
+            if row is not None and self.now - row[3] < self.ttl:
+                self.num_hits += 1
+                return StatResult(path, bool(row[0]), row[1], row[2])
+        self.num_misses += 1
+        return None
+
+    def put(self, result):
+        """Store StatResult"""
+        self._pending_files.append((result.path, int(result.exists), result.size, result.mtime, self.now))
+        if len(self._pending_files) >= self.MAX_PENDING_FILES:
+            self.flush()
+
+    def _dir_tree_mtime(self, dirname):
+        """Get latest mtime of directory & its immediate subdirectories, or None if missing"""
+        try:
+            mtime = os.stat(dirname).st_mtime
+            for name in os.listdir(dirname):
+                subdir = os.path.join(dirname, name)
+                if os.path.isdir(subdir):
+                    mtime = max(mtime, os.stat(subdir).st_mtime)
+        except OSError:
+            return None
+        return mtime
+
+    def get_dir_size(self, dirname, size_func, max_depth=None):
+        """Get size of directory, from cache or by calling size_func(dirname).
+
+        max_depth is the depth limit size_func uses, if any, since sizes
+        measured with different limits differ.
+
+        Safe to call from several threads at once: size_func runs outside the lock.
+        """
+        depth_key = -1 if max_depth is None else max_depth
+        mtime = self._dir_tree_mtime(dirname)
+        if mtime is not None and not self.refresh:
+            with self._lock:
+                row = self._conn.execute("SELECT size, mtime, checked FROM dir_tree_sizes "
+                                         "WHERE path = ? AND max_depth = ?",
+                                         (dirname, depth_key)).fetchone()
+                if row is not None and row[1] == mtime and self.now - row[2] < self.ttl:
+                    self.num_hits += 1
+                    return row[0]
+        with self._lock:
+            self.num_misses += 1
+        size = size_func(dirname)
+        if mtime is not None:
+            with self._lock:
+                self._conn.execute("INSERT OR REPLACE INTO dir_tree_sizes VALUES (?, ?, ?, ?, ?)",
+                                   (dirname, depth_key, size, mtime, self.now))
+        return size
+
+    def print_report(self):
+        total = self.num_hits + self.num_misses
+        print("Stat cache %s: %d hits, %d misses (%.1f%% hit rate)"
+              % (self.filename, self.num_hits, self.num_misses,
+                 100. * self.num_hits / total if total else 0))
+
+
+class StatEngine(object):
+    """Stat files in a bounded pool of threads, with optional rate limiting.
+
+    Parameters
+    ----------
+    num_workers : int
+        Maximum number of stat calls in flight at once
+    max_rate : float, optional
+        Maximum number of stat calls per second on average. None or 0 for no limit.
+    burst : int, optional
+        Number of stat calls allowed in a burst above max_rate. Defaults to max_rate.
+    cache : StatCache, optional
+        If set, use cached results where possible, and store new ones
+    """
+
+    def __init__(self, num_workers=16, max_rate=None, burst=None, cache=None):
+        self.num_workers = max(1, int(num_workers))
+        self.cache = cache
+        self.bucket = TokenBucket(max_rate, burst) if max_rate else None
+        self.histogram = LatencyHistogram()
+        self.num_stats = 0
+        self._elapsed = 0.
+        self._pool = ThreadPool(self.num_workers)
+        # Number of results we allow to be queued ahead of the consumer,
+        # keeps memory bounded for huge inputs
+        self._window = self.num_workers * 64
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def _timed_stat(self, path):
+        if self.bucket:
+            self.bucket.acquire()
+        start = time.time()
+        result = stat_file(path)
+        return result, time.time() - start
+
+    def stat(self, path):
+        """Stat a single file in this thread, see stat_file()"""
+        if self.cache:
+            result = self.cache.get(path)
+            if result is not None:
+                return result
+        return self._collect(path, _DoneResult(self._timed_stat(path)))[1]
+
+    def imap(self, items, key=None):
+        """Stat files concurrently, yielding results in the same order as items.
+
+        Parameters
+        ----------
+        items : iterable
+            Things to stat, consumed lazily
+        key : callable, optional
+            Function to get the filepath from each item, if items aren't filepaths
+
+        Yields
+        ------
+        (item, StatResult)
+        """
+        start = time.time()
+        pending = deque()
+        try:
+            for item in items:
+                path = key(item) if key else item
+                result = self.cache.get(path) if self.cache else None
+                if result is not None:
+                    pending.append((item, _DoneResult((result, None))))
+                else:
+                    pending.append((item, self._pool.apply_async(self._timed_stat, (path,))))
+                if len(pending) >= self._window:
+                    yield self._collect(*pending.popleft())
+            while pending:
+                yield self._collect(*pending.popleft())
+        finally:
+            self._elapsed += time.time() - start
+
+    def _collect(self, item, async_result):
+        result, latency = async_result.get()
+        if latency is not None:
+            # i.e. not from cache
+            self.histogram.add(latency)
+            self.num_stats += 1
+            if self.cache:
+                self.cache.put(result)
+        return item, result
+
+    def print_report(self):
+        """Print throughput & latency histogram of stat calls so far"""
+        rate = self.num_stats / self._elapsed if self._elapsed > 0 else 0
+        print("Stat-ed %d files in %.1f s: %.1f files/s with %d workers"
+              % (self.num_stats, self._elapsed, rate, self.num_workers))
+        if self.num_stats:
+            print("Stat latency histogram (max %.1f ms):" % self.histogram.max_ms)
+            for line in self.histogram.format_lines():
+                print(line)
+        if self.cache:
+            self.cache.print_report()
+
+
+class _DoneResult(object):
+    """Stand-in for AsyncResult when we already have the result"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def add_stat_cache_args(parser):
+    """Add the command-line options for a StatCache to an argparse parser"""
+    parser.add_argument("--statCache",
+                        help="SQLite file to cache stat results between runs, "
+                        "preferably on local disk. Default is not to cache.")
+    parser.add_argument("--cacheTTL",
+                        default=7*24, type=float,
+                        help="Maximum age of cached stat results to use, in hours.")
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="Ignore cached stat results, stat everything again.")
+
+
+def stat_cache_from_args(args):
+    """Create StatCache from options added by add_stat_cache_args(), or None if not wanted"""
+    if not args.statCache:
+        return None
+    return StatCache(args.statCache, ttl=args.cacheTTL * 3600, refresh=args.refresh)
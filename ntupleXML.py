@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+
+"""Stream ntuple entries out of UHH2 dataset XML files.
+
+This is the common parser used by datasetInfo.py, findAllNtupleDirs.py,
+crabKillXMLCheck.py and copyCompress/doCopyCompressJobs.py, so they all agree
+on what counts as a (commented-out) ntuple entry.
+
+Can also be run directly to print the ntuples in XML file(s), one per line.
+"""
+
+
+from __future__ import print_function
+
+import re
+import sys
+import argparse
+from collections import namedtuple
+
+
+# To hold info about one <In FileName=... Lumi=.../> entry
+# line_num counts from 1, commented is True if inside a <!-- --> block
+NtupleEntry = namedtuple('NtupleEntry', 'path lumi line_num commented')
+
+
+ENTRY_RE = re.compile(r'<In\s+FileName\s*=\s*"([^"]*)"(?:\s+Lumi\s*=\s*"([^"]*)")?')
+
+COMMENT_START = "<!--"
+COMMENT_END = "-->"
+
+
+# Lumi values are nearly always the same handful of strings, so cache their conversion
+_LUMI_CACHE = {"": 0.0}
+
+
+def _entries_in_segment(segment, line_num, commented):
+    """Get list of NtupleEntry for each entry in a segment of a line"""
+    entries = []
+    for path, lumi in ENTRY_RE.findall(segment):
+        try:
+            lumi_value = _LUMI_CACHE[lumi]
+        except KeyError:
+            lumi_value = _LUMI_CACHE.setdefault(lumi, float(lumi))
+        entries.append(NtupleEntry(path.strip(), lumi_value, line_num, commented))
+    return entries
+
+
+def iter_entries(lines, include_commented=False):
+    """Yield ntuple entries from an iterable of XML lines.
+
+    Handles comments that span several lines, and comments that start or end
+    part-way through a line.
+
+    Parameters
+    ----------
+    lines : iterable[str]
+        Lines of XML, e.g. an open file object
+    include_commented : bool, optional
+        If True, also yield entries inside comments (with commented=True)
+
+    Yields
+    ------
+    NtupleEntry
+    """
+    in_comment = False
+    for line_num, line in enumerate(lines, 1):
+        has_markers = COMMENT_START in line or COMMENT_END in line
+        if not has_markers:
+            # Fast path: the whole line has the same comment state
+            if "FileName" not in line or (in_comment and not include_commented):
+                continue
+            for entry in _entries_in_segment(line, line_num, in_comment):
+                yield entry
+            continue
+
+        # Slow path: split line into alternating (un)commented segments
+        pos = 0
+        while pos < len(line):
+            marker = COMMENT_END if in_comment else COMMENT_START
+            end = line.find(marker, pos)
+            stop = len(line) if end < 0 else end
+            segment = line[pos:stop]
+            if "FileName" in segment and (include_commented or not in_comment):
+                for entry in _entries_in_segment(segment, line_num, in_comment):
+                    yield entry
+            if end < 0:
+                break
+            in_comment = not in_comment
+            pos = end + len(marker)
+
+
+def iter_xml_entries(xml_filename, include_commented=False):
+    """Yield ntuple entries from an XML file, see iter_entries()"""
+    with open(xml_filename) as f:
+        for entry in iter_entries(f, include_commented=include_commented):
+            yield entry
+
+
+def iter_corpus_entries(xml_filenames, include_commented=False):
+    """Yield (XML filename, ntuple entry) over many XML files in one pass"""
+    for xml_filename in xml_filenames:
+        for entry in iter_xml_entries(xml_filename, include_commented=include_commented):
+            yield xml_filename, entry
+
+
+def get_ntuple_filenames(xml_filename, prefixes=None):
+    """Get list of un-commented ntuple filenames in an XML file.
+
+    Parameters
+    ----------
+    xml_filename : str
+    prefixes : tuple[str], optional
+        If set, only keep filenames starting with one of these, e.g. ("/nfs", "/pnfs")
+
+    Returns
+    -------
+    list[str]
+    """
+    filenames = [e.path for e in iter_xml_entries(xml_filename)]
+    if prefixes:
+        filenames = [f for f in filenames if f.startswith(prefixes)]
+    return filenames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("xml", help="XML file(s) to read", nargs="+")
+    parser.add_argument("--commented",
+                        help="Also print commented-out ntuples, prefixed by #",
+                        action="store_true")
+    args = parser.parse_args()
+
+    for xml_filename, entry in iter_corpus_entries(args.xml, include_commented=args.commented):
+        print(("# " if entry.commented else "") + entry.path)
+    sys.exit(0)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+
+"""Tests for reading DAGman node status files with DAGstatus.
+
+Run with: python -m pytest tests
+"""
+
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+from benchmark_DAGstatus import load_dagstatus, make_status_file
+
+
+DAGstatus = load_dagstatus()
+
+
+class TestParseStatusFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.status_filename = os.path.join(self.tmp_dir, "test.status")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_status(self, text):
+        with open(self.status_filename, "w") as f:
+            f.write(text)
+
+    def test_complete_file(self):
+        make_status_file(self.status_filename, 7)
+        filename, result, error = DAGstatus.parse_status_file(self.status_filename)
+        self.assertEqual(filename, self.status_filename)
+        self.assertIsNone(error)
+        dag_status, node_statuses, status_end = result
+        self.assertEqual(len(node_statuses), 7)
+        self.assertIsNotNone(status_end)
+
+    def test_empty_value(self):
+        # e.g. DAGman was in the middle of writing the file
+        make_status_file(self.status_filename, 7)
+        with open(self.status_filename) as f:
+            text = f.read()
+        self.write_status(text.replace("NodesFailed = 1;", "NodesFailed = ;", 1))
+        filename, result, error = DAGstatus.parse_status_file(self.status_filename)
+        self.assertIsNone(result)
+        self.assertIn("invalid literal", error)
+
+    def test_truncated_file(self):
+        make_status_file(self.status_filename, 7)
+        with open(self.status_filename) as f:
+            text = f.read()
+        # Cut off in the middle of the DagStatus block
+        self.write_status(text[:text.index("NodesFailed = ") + len("NodesFailed = ")])
+        filename, result, error = DAGstatus.parse_status_file(self.status_filename)
+        self.assertIsNone(result)
+        self.assertTrue(error)
+
+    def test_empty_file(self):
+        self.write_status("")
+        filename, result, error = DAGstatus.parse_status_file(self.status_filename)
+        self.assertIsNone(result)
+        self.assertTrue(error)
+
+    def test_missing_file(self):
+        filename, result, error = DAGstatus.parse_status_file(os.path.join(self.tmp_dir, "nope.status"))
+        self.assertIsNone(result)
+        self.assertTrue(error)
+
+
+if __name__ == "__main__":
+    unittest.main()